@@ -0,0 +1,71 @@
+#! /usr/bin/env python3
+"""Compact Registry Memory and Throughput Benchmark."""
+
+import argparse
+import gc
+import time
+import tracemalloc
+
+from wavefront_pyformance import compact_registry
+from wavefront_pyformance import tagged_registry
+
+
+def populate(reg, series):
+    """Register the given number of tagged gauges and counters."""
+    for i in range(series):
+        tags = {'pod': f'pod-{i % 500}', 'endpoint': f'/api/{i}'}
+        reg.gauge('bench.gauge', tags=tags).set_value(i)
+        reg.counter('bench.counter', tags=tags).inc(i)
+
+
+def measure_memory(registry_class, series):
+    """Return bytes allocated by a registry holding the given series."""
+    gc.collect()
+    tracemalloc.start()
+    reg = registry_class()
+    populate(reg, series)
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return reg, used
+
+
+def measure_updates(reg, updates, repeat=5):
+    """Return tagged lookups + updates per second, best of repeat runs."""
+    tags = {'pod': 'pod-1', 'endpoint': '/api/1'}
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for i in range(updates):
+            reg.gauge('bench.gauge', tags=tags).set_value(i)
+            reg.counter('bench.counter', tags=tags).inc()
+        best = min(best, time.perf_counter() - start)
+    return 2 * updates / best
+
+
+def measure_dump(reg):
+    """Return seconds spent in one dump_metrics() call."""
+    start = time.perf_counter()
+    reg.dump_metrics()
+    return time.perf_counter() - start
+
+
+def run(series, updates):
+    """Run the benchmark for both registry layouts and print results."""
+    for registry_class in (tagged_registry.TaggedRegistry,
+                           compact_registry.CompactTaggedRegistry):
+        reg, used = measure_memory(registry_class, series)
+        print(f'{registry_class.__name__}: '
+              f'memory={used / 2 ** 20:.1f}MiB '
+              f'updates={measure_updates(reg, updates):,.0f}/s '
+              f'dump={measure_dump(reg) * 1000:.0f}ms')
+
+
+if __name__ == '__main__':
+    # python benchmark_compact_registry.py --series 200000
+    arg = argparse.ArgumentParser()
+    arg.add_argument('--series', type=int, default=100000,
+                     help='Number of gauge and counter series each.')
+    arg.add_argument('--updates', type=int, default=200000,
+                     help='Number of gauge and counter updates each.')
+    ARGS = arg.parse_args()
+    run(ARGS.series, ARGS.updates)
@@ -0,0 +1,67 @@
+#! /usr/bin/env python3
+"""Adaptive Sampling Synthetic Load Benchmark."""
+
+import argparse
+import random
+import threading
+import time
+
+from wavefront_pyformance import sampling
+from wavefront_pyformance import tagged_registry
+from wavefront_pyformance import wavefront_histogram
+
+
+def load(hist, timer, stop, counts, index):
+    """Record random latencies until stopped, counting the true events."""
+    count = 0
+    while not stop.is_set():
+        value = random.expovariate(1 / 50.0)
+        hist.add(value)
+        with timer.time():
+            pass
+        count += 1
+    counts[index] = count
+
+
+def run(threads, cycles, cycle_seconds, cpu_budget):
+    """Run the synthetic load and print sampling rate and count accuracy."""
+    sampler = sampling.AdaptiveSampler(cpu_budget=cpu_budget)
+    reg = tagged_registry.TaggedRegistry()
+    hist = wavefront_histogram.wavefront_histogram(reg, 'latency',
+                                                   sampler=sampler)
+    timer = sampling.sampled_timer(reg, 'duration', sampler)
+    stop = threading.Event()
+    counts = [0] * threads
+    workers = [threading.Thread(target=load,
+                                args=(hist, timer, stop, counts, index))
+               for index in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for cycle in range(cycles):
+        time.sleep(cycle_seconds)
+        sampler.update(report_lag=0.0)
+        print(f'cycle {cycle}: rate={sampler.rate:.3f}')
+    stop.set()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    true_count = sum(counts)
+    print(f'events={true_count:,} ({true_count / elapsed:,.0f}/s) '
+          f'timer estimate={timer.get_count():,.0f} '
+          f'error={abs(timer.get_count() - true_count) / true_count:.2%}')
+
+
+if __name__ == '__main__':
+    # python benchmark_sampling.py --cpu-budget 50
+    arg = argparse.ArgumentParser()
+    arg.add_argument('--threads', type=int, default=4,
+                     help='Number of threads generating load.')
+    arg.add_argument('--cycles', type=int, default=10,
+                     help='Number of sampler update cycles.')
+    arg.add_argument('--cycle-seconds', type=float, default=0.5,
+                     help='Seconds between sampler updates.')
+    arg.add_argument('--cpu-budget', type=float, default=None,
+                     help='Process CPU percent above which to sample.')
+    ARGS = arg.parse_args()
+    run(ARGS.threads, ARGS.cycles, ARGS.cycle_seconds, ARGS.cpu_budget)
@@ -1,10 +1,93 @@
 """Delta Metrics Test Module."""
 
+import asyncio
+import gzip
+import http.server
+import json
+import subprocess
+import sys
+import threading
+import time
 import unittest
+from unittest import mock
 
+from wavefront_pyformance import compact_registry
 from wavefront_pyformance import delta
+from wavefront_pyformance import replay
+from wavefront_pyformance import rollup
+from wavefront_pyformance import runtime_metrics
+from wavefront_pyformance import sampling
+from wavefront_pyformance import snapshot
 from wavefront_pyformance import tagged_registry
 from wavefront_pyformance import wavefront_histogram
+from wavefront_pyformance import wavefront_reporter
+
+
+class RecordingClient(object):
+    """Wavefront client stub recording all sent points."""
+
+    def __init__(self):
+        """Construct Recording Client."""
+        self.metrics = []
+        self.delta_counters = []
+        self.distributions = []
+        self.closed = False
+
+    def send_metric(self, name, value, timestamp, source, tags):
+        """Record a metric point."""
+        self.metrics.append((name, value, tags))
+
+    # pylint: disable=unused-argument
+    def send_delta_counter(self, name, value, source, tags, timestamp=None):
+        """Record a delta counter point."""
+        self.delta_counters.append((name, value, tags))
+
+    def send_distribution(self, name, centroids, histogram_granularities,
+                          timestamp, source, tags):
+        """Record a distribution."""
+        self.distributions.append((name, centroids, tags))
+
+    def flush_now(self):
+        """Do nothing."""
+
+    def close(self):
+        """Mark client as closed."""
+        self.closed = True
+
+
+class CaptureHandler(http.server.BaseHTTPRequestHandler):
+    """HTTP handler capturing lines sent to a local stub proxy."""
+
+    lines = []
+
+    # pylint: disable=invalid-name
+    def do_POST(self):
+        """Capture the gzipped lines of a report."""
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        CaptureHandler.lines.extend(
+            gzip.decompress(body).decode('utf-8').splitlines())
+        self.send_response(202)
+        self.end_headers()
+
+    # pylint: disable=redefined-builtin
+    def log_message(self, format, *args):
+        """Do not log requests."""
+
+
+def capture_server():
+    """Start a local stub proxy on a free port, return the server."""
+    CaptureHandler.lines = []
+    server = http.server.HTTPServer(('localhost', 0), CaptureHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def recording_reporter(registry, **kwargs):
+    """Create a WavefrontReporter sending to a RecordingClient."""
+    reporter = wavefront_reporter.WavefrontReporter(registry=registry,
+                                                    **kwargs)
+    reporter.wavefront_client = RecordingClient()
+    return reporter
 
 
 class TestDelta(unittest.TestCase):
@@ -49,6 +132,702 @@ class TestDelta(unittest.TestCase):
                           wavefront_histogram.WavefrontHistogram)
 
 
+class TestExemplars(unittest.TestCase):
+    """Wavefront Histogram Exemplars Test Case."""
+
+    def test_top_k_per_minute(self):
+        """Test keeping the largest values of each minute bin."""
+        now = [60000]
+        hist = wavefront_histogram.WavefrontHistogram(
+            clock_millis=lambda: now[0], exemplars=2)
+        for value in (5, 1, 9, 3, 7):
+            hist.add(value, context={'trace_id': str(value)})
+        assert hist.get_exemplars() == []
+        assert hist.get_current_minute_exemplars() == [
+            wavefront_histogram.Exemplar(60000, 9, {'trace_id': '9'}),
+            wavefront_histogram.Exemplar(60000, 7, {'trace_id': '7'})]
+
+        now[0] = 120000
+        hist.add(2)
+        assert [e.value for e in hist.get_exemplars()] == [9, 7]
+        assert hist.get_exemplars() == []
+        assert hist.get_current_minute_exemplars() == [
+            wavefront_histogram.Exemplar(120000, 2, None)]
+
+    def test_reporter_exemplars(self):
+        """Test exposing exemplars in the reporter snapshot."""
+        reg = tagged_registry.TaggedRegistry()
+        wavefront_histogram.wavefront_histogram(
+            reg, 'latency', exemplars=1).add(3.0, {'trace_id': 'abc'})
+        reporter = recording_reporter(reg).report_minute_distribution()
+        with self.assertLogs('wavefront_pyformance', level='INFO'):
+            reporter._report(flush_current_hist=True)
+        exemplars = json.loads(reporter.snapshot().to_json())['exemplars']
+        assert exemplars[0]['name'] == 'latency'
+        assert exemplars[0]['exemplars'][0]['context'] == {'trace_id': 'abc'}
+
+    def test_without_exemplars(self):
+        """Test histograms without exemplars."""
+        hist = wavefront_histogram.WavefrontHistogram().add(1.0, {'a': 'b'})
+        assert hist.get_exemplars() == []
+        assert hist.get_current_minute_exemplars() == []
+
+
+class TestSampling(unittest.TestCase):
+    """Adaptive Sampling Test Case."""
+
+    def test_sampler_rate(self):
+        """Test lowering and restoring the rate on report lag and CPU."""
+        sampler = sampling.AdaptiveSampler(min_rate=0.25)
+        sampler.update(report_lag=1.0)
+        assert sampler.rate == 0.5
+        sampler.update(report_lag=1.0)
+        sampler.update(report_lag=1.0)
+        assert sampler.rate == 0.25
+        sampler.update(report_lag=0.0)
+        assert sampler.rate == 0.5
+
+        sampler = sampling.AdaptiveSampler(cpu_budget=-1)
+        sampler.update(report_lag=0.0)
+        assert sampler.rate == 0.5
+        assert sampler.sample() in (0, 2.0)
+
+    def test_weighted_updates(self):
+        """Test scaling counts of sampled histograms and timers."""
+        sampler = sampling.AdaptiveSampler()
+        sampler.rate = 0.5
+        reg = tagged_registry.TaggedRegistry()
+        hist = wavefront_histogram.wavefront_histogram(reg, 'latency',
+                                                       sampler=sampler)
+        timer = sampling.sampled_timer(reg, 'duration', sampler,
+                                       tags={'pod': 'a'})
+        assert sampling.sampled_timer(reg, 'duration', sampler,
+                                      tags={'pod': 'a'}) is timer
+        for _ in range(2000):
+            hist.add(1.0)
+            with timer.time():
+                pass
+        hist_count = sum(count for dist in
+                         hist.get_current_minute_distribution()
+                         for _, count in dist.centroids)
+        assert 1600 < hist_count < 2400
+        assert hist_count % 2 == 0
+        assert 1600 < timer.get_count() < 2400
+        assert timer.get_count() == timer.meter.get_count()
+
+    def test_add_weighted_stats(self):
+        """Test weighted values give the statistics of repeated values."""
+        weighted, repeated = hists = (
+            tagged_registry.TaggedRegistry().histogram('weighted'),
+            tagged_registry.TaggedRegistry().histogram('repeated'))
+        for value in range(1, 11):
+            sampling.add_weighted(weighted, value, 4)
+            for _ in range(4):
+                repeated.add(value)
+        for hist in hists:
+            assert hist.get_count() == 40
+            assert hist.get_mean() == 5.5
+        assert abs(weighted.get_stddev() - repeated.get_stddev()) < 1e-9
+        assert abs(weighted.get_stddev() - 2.9089) < 1e-4
+
+    def test_skipped_timer_threshold(self):
+        """Test timer contexts of dropped events still time and signal."""
+        sampler = sampling.AdaptiveSampler()
+        sampler.rate = sampler.min_rate = 0.0
+        timer = sampling.SampledTimer(sampler, threshold=0.001)
+        signalled = []
+        with mock.patch.object(sampling, 'call_too_long') as signal:
+            signal.send.side_effect = lambda *args, **kwargs: (
+                signalled.append(kwargs['elapsed']))
+            context = timer.time()
+            time.sleep(0.01)
+            elapsed = context.stop()
+        assert elapsed >= 0.01
+        assert signalled == [elapsed]
+        assert timer.get_count() == 0
+
+    def test_reporter_sampling_rate(self):
+        """Test reporting the sampling rate as internal metric."""
+        sampler = sampling.AdaptiveSampler()
+        reporter = wavefront_reporter.WavefrontProxyReporter(
+            host='localhost', port=1,
+            registry=tagged_registry.TaggedRegistry(), sampler=sampler)
+        assert reporter._sdk_metrics_registry.metrics[
+            'sampling.rate'].get_value() == 1.0
+        reporter.report_now()
+        reporter._report_seconds = 40
+        reporter.report_now()
+        assert sampler.rate == 1.0
+        reporter._report_seconds = 40
+        reporter._update_sampler()
+        assert sampler.rate == 0.5
+        reporter.wavefront_client.close()
+        reporter._sdk_metrics_registry.close()
+
+    def test_reporter_sampling_rate_without_cpu_sample(self):
+        """Test the runtime CPU sample not counting as reporting time."""
+        sampler = sampling.AdaptiveSampler()
+        reporter = wavefront_reporter.WavefrontReporter(
+            registry=tagged_registry.TaggedRegistry(), reporting_interval=0.2,
+            enable_runtime_metrics=True,
+            runtime_collectors=[runtime_metrics.CpuPercentCollector()],
+            sampler=sampler)
+
+        def cpu_percent(interval=None):
+            time.sleep(interval / 2)
+            return 0.0
+
+        with mock.patch('psutil.Process.cpu_percent', side_effect=cpu_percent):
+            for _ in range(3):
+                reporter.report_now()
+                reporter._update_sampler()
+        assert reporter._cpu_sample_seconds >= 0.5
+        assert sampler.rate == 1.0
+
+
+class TestReplay(unittest.TestCase):
+    """Workload Replay Test Case."""
+
+    def test_record_profile(self):
+        """Test recording series, tag cardinality, rates and values."""
+        reg = tagged_registry.TaggedRegistry()
+        for pod in range(3):
+            reg.counter('requests', tags={'pod': str(pod), 'env': 'prod'})
+        reg.histogram('size').add(4)
+
+        def update(_):
+            for pod in range(3):
+                reg.counter('requests', tags={'pod': str(pod),
+                                              'env': 'prod'}).inc(2)
+            reg.histogram('size').add(6)
+
+        with mock.patch.object(replay.time, 'sleep', side_effect=update):
+            profile = replay.WorkloadProfile.record(reg, seconds=2)
+        profile = replay.WorkloadProfile.from_json(profile.to_json())
+        groups = {group['name']: group for group in profile.groups}
+        assert groups['requests']['type'] == replay.COUNTER
+        assert groups['requests']['series'] == 3
+        assert groups['requests']['tags'] == {'env': 1, 'pod': 3}
+        assert groups['requests']['rate'] == 3
+        assert groups['size']['rate'] == 0.5
+        assert sorted(groups['size']['values']) == [4, 6]
+
+    def test_record_compact_registry(self):
+        """Test recording compact counters and gauges."""
+        reg = compact_registry.CompactTaggedRegistry()
+        for pod in range(3):
+            reg.counter('requests', tags={'pod': str(pod)})
+            reg.gauge('queue', tags={'pod': str(pod)}).set_value(pod)
+
+        def update(_):
+            for pod in range(3):
+                reg.counter('requests', tags={'pod': str(pod)}).inc(2)
+
+        with mock.patch.object(replay.time, 'sleep', side_effect=update):
+            profile = replay.WorkloadProfile.record(reg, seconds=2)
+        groups = {group['name']: group for group in profile.groups}
+        assert groups['requests']['type'] == replay.COUNTER
+        assert groups['requests']['series'] == 3
+        assert groups['requests']['rate'] == 3
+        assert groups['queue']['type'] == replay.GAUGE
+        assert groups['queue']['series'] == 3
+        assert sorted(groups['queue']['values']) == [0, 1, 2]
+
+    def test_record_samples_centroids(self):
+        """Test sampling Wavefront histogram centroids by weight."""
+        reg = tagged_registry.TaggedRegistry()
+        hist = wavefront_histogram.wavefront_histogram(reg, 'latency')
+        for _ in range(5000):
+            hist.add(1.0)
+            hist.add(3.0)
+        with mock.patch.object(replay.time, 'sleep'):
+            profile = replay.WorkloadProfile.record(reg, seconds=1,
+                                                    max_values=100)
+        values = profile.groups[0]['values']
+        assert len(values) == 100
+        assert set(values) == {1.0, 3.0}
+
+    def test_deterministic_replay(self):
+        """Test same profile and seed replay the same registry updates."""
+        profile = replay.WorkloadProfile([
+            {'name': 'requests', 'type': replay.COUNTER, 'series': 6,
+             'tags': {'pod': 3, 'env': 2}, 'rate': 100},
+            {'name': 'latency', 'type': replay.TIMER, 'series': 1,
+             'tags': {}, 'rate': 25, 'values': [0.1, 0.2, 0.5]},
+            {'name': 'lat', 'type': replay.WAVEFRONT_HISTOGRAM, 'series': 2,
+             'tags': {'pod': 2}, 'rate': 10, 'values': [1, 2]}])
+        dumps = []
+        for _ in range(2):
+            workload = replay.WorkloadReplay(profile, seed=7)
+            assert workload.step(0.5) + workload.step(0.5) == 135
+            # meter rates depend on time, compare counts and sums
+            dumps.append({key: (values.get('count'), values.get('sum'))
+                          for key, values
+                          in workload.registry.dump_metrics().items()})
+        assert dumps[0] == dumps[1]
+        counts = [count for key, (count, _) in dumps[0].items()
+                  if key.startswith('requests')]
+        assert len(counts) == 6 and sum(counts) == 100
+
+    def test_replay_to_capture_server(self):
+        """Test replaying against a proxy reporter and capture server."""
+        profile = replay.WorkloadProfile([
+            {'name': 'requests', 'type': replay.COUNTER, 'series': 4,
+             'tags': {'pod': 4}, 'rate': 100}])
+        stats = replay.replay(profile, duration=0.2, reporting_interval=0.1,
+                              tick=0.05)
+        assert [cycle.cycle for cycle in stats] == [0, 1]
+        assert sum(cycle.points for cycle in stats) >= 4
+        assert all(cycle.rss_mib > 0 for cycle in stats)
+        assert stats[-1].failures == 0
+
+
+class TestCompactRegistry(unittest.TestCase):
+    """Compact Tagged Registry Test Case."""
+
+    def test_compact_counter_and_gauge(self):
+        """Test array-backed counters and gauges."""
+        reg = compact_registry.CompactTaggedRegistry()
+        reg.counter('foo', tags={'pod': 'a'}).inc(3)
+        reg.counter('foo', tags={'pod': 'a'}).dec()
+        reg.counter('foo', tags={'pod': 'b'}).inc()
+        reg.gauge('bar', tags={'pod': 'a'}).set_value(1.5)
+        assert reg.has_counter('foo', tags={'pod': 'a'})
+        assert reg.has_gauge('bar', tags={'pod': 'a'})
+        assert not reg.has_gauge('bar', tags={'pod': 'b'})
+
+        metrics = reg.dump_metrics()
+        assert metrics[reg.encode_key('foo', {'pod': 'a'})] == {'count': 2}
+        assert metrics[reg.encode_key('foo', {'pod': 'b'})] == {'count': 1}
+        assert metrics[reg.encode_key('bar', {'pod': 'a'})] == {'value': 1.5}
+
+        with self.assertRaises(TypeError):
+            reg.counter('foo', tags={'pod': 'a'}).inc(1.5)
+
+    def test_compact_handles_after_clear(self):
+        """Test handles obtained before clear() update the new slots."""
+        reg = compact_registry.CompactTaggedRegistry()
+        counter = reg.counter('foo')
+        gauge = reg.gauge('bar')
+        counter.inc(5)
+        gauge.set_value(2.5)
+        reg.clear()
+        assert reg.dump_metrics() == {}
+        counter.inc()
+        gauge.set_value(1.5)
+        assert reg.dump_metrics() == {'foo': {'count': 1},
+                                      'bar': {'value': 1.5}}
+        assert reg.counter('foo').get_count() == 1
+
+        reg.clear()
+        reg.add('foo', delta.DeltaCounter())
+        with self.assertRaises(LookupError):
+            counter.inc()
+        assert isinstance(reg.counter('foo'), delta.DeltaCounter)
+
+    def test_compact_registry_fallbacks(self):
+        """Test delta counters and callback gauges in compact registry."""
+        reg = compact_registry.CompactTaggedRegistry()
+        counter = delta.delta_counter(reg, 'foo')
+        counter.inc(2)
+        assert delta.delta_counter(reg, 'foo') is counter
+        assert delta.is_delta_counter(delta.DeltaCounter.DELTA_PREFIX + 'foo',
+                                      reg)
+        reg.gauge('bar', lambda: 42)
+        metrics = reg.dump_metrics()
+        assert metrics[delta.DeltaCounter.DELTA_PREFIX + 'foo'] == {
+            'count': 2}
+        assert metrics['bar'] == {'value': 42}
+
+        reg.counter('baz').inc()
+        with self.assertRaises(LookupError):
+            reg.add('baz', delta.DeltaCounter())
+
+
+class TestRollup(unittest.TestCase):
+    """Rollup Test Case."""
+
+    def test_rollup_counters(self):
+        """Test summing counters and delta counters across a tag."""
+        reg = tagged_registry.TaggedRegistry()
+        reg.counter('requests', tags={'pod': 'a', 'code': '200'}).inc(2)
+        reg.counter('requests', tags={'pod': 'b', 'code': '200'}).inc(3)
+        reg.counter('other', tags={'pod': 'a'}).inc()
+        delta.delta_counter(reg, 'calls', tags={'pod': 'a'}).inc(4)
+        delta.delta_counter(reg, 'calls', tags={'pod': 'b'}).inc(5)
+        reporter = recording_reporter(
+            reg, rollup_rules=[rollup.RollupRule('requests', ['pod']),
+                               rollup.RollupRule('calls', ['pod'])])
+        reporter.report_now()
+        client = reporter.wavefront_client
+
+        assert ('requests.count', 5, {'code': '200'}) in client.metrics
+        assert ('other.count', 1, {'pod': 'a'}) in client.metrics
+        assert len(client.metrics) == 2
+        assert client.delta_counters == [
+            (delta.get_delta_name('', delta.DeltaCounter.DELTA_PREFIX +
+                                  'calls', 'count'), 9, {})]
+        assert not reg.counter(delta.DeltaCounter.DELTA_PREFIX + 'calls',
+                               tags={'pod': 'a'}).get_count()
+
+    def test_rollup_distributions(self):
+        """Test merging Wavefront histograms across a tag."""
+        reg = tagged_registry.TaggedRegistry()
+        for endpoint, value in (('/a', 1.0), ('/b', 1.0), ('/c', 3.0)):
+            wavefront_histogram.wavefront_histogram(
+                reg, 'latency', tags={'endpoint': endpoint}).add(value)
+        reporter = recording_reporter(
+            reg, rollup_rules=[rollup.RollupRule('lat*', ['endpoint'])])
+        reporter._report(flush_current_hist=True)
+        distributions = reporter.wavefront_client.distributions
+        assert len(distributions) == 1
+        name, centroids, tags = distributions[0]
+        assert (name, tags) == ('latency', {})
+        assert sorted(centroids) == [(1.0, 2), (3.0, 1)]
+
+    def test_rollup_timers_and_gauges(self):
+        """Test only aggregatable timer values and opted-in gauges roll up."""
+        reg = tagged_registry.TaggedRegistry()
+        for pod, seconds in (('a', 0.1), ('b', 0.3)):
+            reg.timer('lat', tags={'pod': pod})._update(seconds)
+            reg.gauge('queue', tags={'pod': pod}).set_value(2)
+            reg.gauge('temp', tags={'pod': pod}).set_value(20)
+        reporter = recording_reporter(
+            reg, rollup_rules=[rollup.RollupRule('lat', ['pod']),
+                               rollup.RollupRule('queue', ['pod'],
+                                                 gauges=True),
+                               rollup.RollupRule('temp', ['pod'])])
+        reporter.report_now()
+        metrics = {(name, tuple(sorted(tags.items()))): value
+                   for name, value, tags in reporter.wavefront_client.metrics}
+
+        assert metrics[('lat.count', ())] == 2
+        assert abs(metrics[('lat.sum', ())] - 0.4) < 1e-9
+        assert metrics[('lat.min', ())] == 0.1
+        assert metrics[('lat.max', ())] == 0.3
+        assert ('lat.avg', ()) not in metrics
+        assert ('lat.mean_rate', ()) not in metrics
+        assert ('lat.99_percentile', ()) not in metrics
+        assert metrics[('queue.value', ())] == 4
+        assert metrics[('temp.value', (('pod', 'a'),))] == 20
+        assert metrics[('temp.value', (('pod', 'b'),))] == 20
+        assert len(metrics) == 7
+
+    def test_invalid_aggregation(self):
+        """Test unknown aggregation."""
+        with self.assertRaises(ValueError):
+            rollup.RollupRule('foo', ['pod'], aggregation='avg')
+
+
+class TestExportDeltas(unittest.TestCase):
+    """Delta Export Test Case."""
+
+    def test_histogram_deltas(self):
+        """Test reporting histograms as interval deltas."""
+        reg = tagged_registry.TaggedRegistry()
+        hist = reg.histogram('latency', tags={'pod': 'a'})
+        for value in (1.0, 2.0, 2.0):
+            hist.add(value)
+        reporter = recording_reporter(reg, export_deltas=True)
+        reporter.report_now()
+        client = reporter.wavefront_client
+        delta_name = delta.DeltaCounter.DELTA_PREFIX + 'latency'
+        assert client.delta_counters == [
+            (delta.get_delta_name('', delta_name, 'count'), 3, {'pod': 'a'}),
+            (delta.get_delta_name('', delta_name, 'sum'), 5, {'pod': 'a'})]
+        assert client.distributions == [
+            ('latency', [(1.0, 1), (2.0, 2)], {'pod': 'a'})]
+        assert not client.metrics
+
+        reporter.wavefront_client = client = RecordingClient()
+        hist.add(4.0)
+        reporter.report_now()
+        assert [value for _, value, _ in client.delta_counters] == [1, 4]
+        assert client.distributions == [
+            ('latency', [(4.0, 1)], {'pod': 'a'})]
+
+        reporter.wavefront_client = client = RecordingClient()
+        reporter.report_now()
+        assert not client.delta_counters and not client.distributions
+
+        # a lower count is a reset, not a negative delta
+        hist.clear()
+        hist.add(3.0)
+        reporter.wavefront_client = client = RecordingClient()
+        reporter.report_now()
+        assert [value for _, value, _ in client.delta_counters] == [1, 3]
+
+        reg.clear()
+        reporter.report_now()
+        assert not reporter._reported_totals
+
+    def test_meter_and_timer_deltas(self):
+        """Test reporting meters and timers as interval deltas."""
+        reg = tagged_registry.TaggedRegistry()
+        reg.meter('calls').mark(3)
+        reg.timer('duration')._update(0.5)
+        reporter = recording_reporter(reg, export_deltas=True)
+        reporter.report_now()
+        client = reporter.wavefront_client
+        calls_name = delta.get_delta_name(
+            '', delta.DeltaCounter.DELTA_PREFIX + 'calls', 'count')
+        assert (calls_name, 3, {}) in client.delta_counters
+        assert len(client.delta_counters) == 3
+        assert client.distributions == [('duration', [(0.5, 1)], {})]
+
+
+class TestSnapshot(unittest.TestCase):
+    """Metrics Snapshot Test Case."""
+
+    def test_snapshot_consumers(self):
+        """Test sharing one report cycle between consumers."""
+        reg = tagged_registry.TaggedRegistry()
+        reg.counter('requests', tags={'path': '/a "b"'}).inc(2)
+        delta.delta_counter(reg, 'calls').inc(3)
+        wavefront_histogram.wavefront_histogram(reg, 'latency').add(2.0)
+        reporter = recording_reporter(
+            reg, source='host-1').report_minute_distribution()
+        assert reporter.snapshot() is None
+        reporter._report(flush_current_hist=True)
+        metrics_snapshot = reporter.snapshot()
+        assert len(metrics_snapshot.points) == 3
+        assert len(reporter.wavefront_client.metrics) == 1
+        assert len(reporter.wavefront_client.delta_counters) == 1
+        assert len(reporter.wavefront_client.distributions) == 1
+
+        assert metrics_snapshot.to_prometheus_text().splitlines() == [
+            '# TYPE calls_count gauge',
+            'calls_count{source="host-1"} 3.0',
+            '# TYPE latency summary',
+            'latency_count{source="host-1"} 1',
+            'latency_sum{source="host-1"} 2.0',
+            '# TYPE requests_count gauge',
+            'requests_count{path="/a \\"b\\"",source="host-1"} 2.0']
+        points = json.loads(metrics_snapshot.to_json())['points']
+        assert {point['kind'] for point in points} == {
+            'metric', 'delta_counter', 'distribution'}
+        assert reporter.snapshot() is metrics_snapshot
+
+    def test_prometheus_merges_series(self):
+        """Test one summary per series and one type per name."""
+        metrics_snapshot = snapshot.MetricsSnapshot('host-1')
+        for minute in (0, 60000, 120000):
+            metrics_snapshot.send_distribution(
+                'lat', [(1.0, 2), (3.0, 1)], None, minute, 'host-1', None)
+        metrics_snapshot.send_metric('lat', 7, None, 'host-1', None)
+        metrics_snapshot.send_metric('queue', 1, None, 'host-1', None)
+        metrics_snapshot.send_metric('queue', 2, None, 'host-1', None)
+        metrics_snapshot.send_metric('queue', None, None, 'host-1',
+                                     {'pod': 'a'})
+        metrics_snapshot.send_metric('up', 1, None, 'host-1',
+                                     {'k8s:pod': 'x', '1st': 'y'})
+        assert metrics_snapshot.to_prometheus_text().splitlines() == [
+            '# TYPE lat summary',
+            'lat_count{source="host-1"} 9',
+            'lat_sum{source="host-1"} 15.0',
+            '# TYPE queue gauge',
+            'queue{source="host-1"} 2.0',
+            '# TYPE up gauge',
+            'up{_1st="y",k8s_pod="x",source="host-1"} 1.0']
+
+    def test_snapshot_without_client(self):
+        """Test taking snapshots without Wavefront client."""
+        reg = tagged_registry.TaggedRegistry()
+        reg.gauge('queue').set_value(4)
+        reporter = wavefront_reporter.WavefrontReporter(registry=reg)
+        reporter.report_now()
+        assert reporter.snapshot().points[0].value == 4
+
+
+class TestFlush(unittest.TestCase):
+    """Flush on Exit Test Case."""
+
+    def test_context_manager(self):
+        """Test reporting once when leaving the context manager."""
+        server = capture_server()
+        reg = tagged_registry.TaggedRegistry()
+        with wavefront_reporter.WavefrontProxyReporter(
+                host='localhost', port=server.server_port, registry=reg,
+                prefix='', enable_internal_metrics=False,
+                enable_runtime_metrics=True
+        ).report_minute_distribution() as reporter:
+            reg.counter('requests', tags={'pod': 'a'}).inc()
+            wavefront_histogram.wavefront_histogram(reg, 'latency').add(1.0)
+        server.shutdown()
+        server.server_close()
+
+        assert not reporter._loop_thread.is_alive()
+        assert any(line.startswith('"requests.count" 1.0 ')
+                   for line in CaptureHandler.lines)
+        assert any(line.startswith('"cpu.percent.value" ')
+                   for line in CaptureHandler.lines)
+        assert any('"latency"' in line for line in CaptureHandler.lines)
+
+    def test_flush_once(self):
+        """Test flushing only once within timeout."""
+        reg = tagged_registry.TaggedRegistry()
+        reporter = recording_reporter(reg)
+        reg.counter('requests').inc()
+        assert reporter.flush(timeout=1)
+        assert reporter.wavefront_client.closed
+        reporter.wavefront_client = RecordingClient()
+        assert reporter.flush(timeout=1)
+        assert not reporter.wavefront_client.metrics
+
+    def test_flush_without_threads(self):
+        """Test flushing synchronously when no thread can be started."""
+        reg = tagged_registry.TaggedRegistry()
+        reporter = recording_reporter(reg)
+        reg.counter('requests').inc()
+        with mock.patch.object(threading.Thread, 'start',
+                               side_effect=RuntimeError):
+            assert reporter.flush(timeout=1)
+        assert reporter.wavefront_client.metrics
+        assert reporter.wavefront_client.closed
+
+    def test_flush_timeout(self):
+        """Test warning when flushing doesn't complete within timeout."""
+        reporter = recording_reporter(tagged_registry.TaggedRegistry())
+        with mock.patch.object(reporter, '_flush',
+                               side_effect=lambda: time.sleep(0.2)):
+            with self.assertLogs(wavefront_reporter.LOGGER, 'WARNING'):
+                assert not reporter.flush(timeout=0.01)
+
+    def test_stop_after_flush(self):
+        """Test stop() and flush() stop the loop and report only once."""
+        reg = tagged_registry.TaggedRegistry()
+        reporter = recording_reporter(reg, reporting_interval=0.01)
+        client = reporter.wavefront_client
+        reporter.start()
+        reg.counter('requests').inc()
+        time.sleep(0.05)
+        assert reporter.flush(timeout=1)
+        assert not reporter._loop_thread.is_alive()
+        reported = len(client.metrics)
+        reporter.stop()
+        reporter.flush(timeout=1)
+        assert len(client.metrics) == reported
+        assert client.closed
+
+
+class TestRuntimeMetrics(unittest.TestCase):
+    """Runtime Metrics Test Case."""
+
+    class CountingCollector(runtime_metrics.Collector):
+        """Collector counting its collections."""
+
+        def __init__(self, interval=1):
+            """Construct Counting Collector."""
+            super().__init__(interval)
+            self.collections = 0
+
+        def collect(self, process):
+            """Count collections."""
+            self.collections += 1
+            self.set_value('collections', self.collections)
+
+    def test_collector_interval(self):
+        """Test collectors only running every interval cycles."""
+        reg = tagged_registry.TaggedRegistry()
+        every, third = (self.CountingCollector(),
+                        self.CountingCollector(interval=3))
+        col = runtime_metrics.RuntimeCollector(reg, collectors=[every, third])
+        for _ in range(4):
+            col.collect()
+        assert every.collections == 4
+        assert third.collections == 2
+        assert reg.gauge('collections', tags=col.custom_tags).get_value() == 2
+
+    def test_default_collectors(self):
+        """Test default collectors registering gauges once."""
+        reg = tagged_registry.TaggedRegistry()
+        col = runtime_metrics.RuntimeCollector(reg, cpu_percent_interval=None)
+        col.collect()
+        gauges = dict(reg._gauges)
+        col.collect()
+        assert reg._gauges == gauges
+        assert reg.has_gauge('thread.count', tags=col.custom_tags)
+        assert reg.has_gauge('fd.count', tags=col.custom_tags)
+
+    def test_collect_after_clear(self):
+        """Test collectors registering their gauges again after clear()."""
+        for reg in (tagged_registry.TaggedRegistry(),
+                    compact_registry.CompactTaggedRegistry()):
+            collector = self.CountingCollector()
+            col = runtime_metrics.RuntimeCollector(reg, collectors=[collector])
+            col.collect()
+            reg.clear()
+            col.collect()
+            assert reg.dump_metrics() == {
+                reg.encode_key('collections', col.custom_tags): {'value': 2}}
+
+    def test_invalid_interval(self):
+        """Test collector intervals below 1."""
+        with self.assertRaises(ValueError):
+            self.CountingCollector(interval=0)
+
+    def test_asyncio_collector(self):
+        """Test counting the tasks of an event loop from another thread."""
+        reg = tagged_registry.TaggedRegistry()
+        collectors = []
+
+        async def main():
+            collectors.append(runtime_metrics.RuntimeCollector(
+                reg, collectors=[runtime_metrics.AsyncioCollector(
+                    asyncio.get_running_loop())]))
+            task = asyncio.ensure_future(asyncio.sleep(1))
+            await asyncio.to_thread(collectors[0].collect)
+            task.cancel()
+
+        asyncio.run(main())
+        assert reg.gauge('asyncio.tasks.count',
+                         tags=collectors[0].custom_tags).get_value() == 2
+
+    def test_collect_methods(self):
+        """Test the collect_* methods running single collectors."""
+        reg = tagged_registry.TaggedRegistry()
+        col = runtime_metrics.RuntimeCollector(reg, collectors=[])
+        col.collect_cputimes()
+        col.collect_memorypercent()
+        col.collect_threads()
+        assert reg.has_gauge('cpu.times.usermode', tags=col.custom_tags)
+        assert reg.has_gauge('memory.rss.percent', tags=col.custom_tags)
+        assert reg.has_gauge('thread.count', tags=col.custom_tags)
+        assert not reg.has_gauge('gc.objects.count', tags=col.custom_tags)
+
+
+class TestImportTime(unittest.TestCase):
+    """Import Time Test Case."""
+
+    LAZY_MODULES = ('importlib.metadata', 'psutil', 'wavefront_sdk',
+                    'wavefront_pyformance.runtime_metrics')
+
+    @staticmethod
+    def import_times(statement):
+        """Run statement with -X importtime, return cumulative us by module."""
+        stderr = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', statement],
+            check=True, capture_output=True, text=True).stderr
+        times = {}
+        for line in stderr.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                _, cumulative, module = line.split('|')
+                if cumulative.strip().isdigit():
+                    times[module.strip()] = int(cumulative)
+        return times
+
+    def test_lazy_imports(self):
+        """Test instrumentation imports don't load SDK, psutil, etc."""
+        times = self.import_times(
+            'import wavefront_pyformance.wavefront_reporter, '
+            'wavefront_pyformance.wavefront_histogram, '
+            'wavefront_pyformance.compact_registry')
+        assert 'wavefront_pyformance.wavefront_reporter' in times
+        for module in times:
+            assert module.split('.')[0] not in self.LAZY_MODULES, module
+            assert module not in self.LAZY_MODULES, module
+
+
 if __name__ == '__main__':
     # run 'python -m unittest discover' from toplevel to run tests
     unittest.main()
@@ -1,13 +1,20 @@
 """Wavefront PyFormance Plugin."""
 
-__version__ = None
 
-try:
-    import importlib.metadata
+def __getattr__(name):
+    """Resolve __version__ lazily, importlib.metadata is slow to import."""
+    if name != '__version__':
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    version = None
     try:
-        __version__ = importlib.metadata.version('wavefront-pyformance')
-    except importlib.metadata.PackageNotFoundError:
-        # __version__ is only available when distribution is installed.
+        # pylint: disable=import-outside-toplevel
+        import importlib.metadata
+        try:
+            version = importlib.metadata.version('wavefront-pyformance')
+        except importlib.metadata.PackageNotFoundError:
+            # __version__ is only available when distribution is installed.
+            pass
+    except ImportError:
         pass
-except ImportError:
-    pass
+    globals()['__version__'] = version
+    return version
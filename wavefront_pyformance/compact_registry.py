@@ -0,0 +1,270 @@
+"""
+Compact Tagged Metrics Registry.
+
+Stores counters and settable gauges in contiguous arrays instead of one
+pyformance object per series, for registries with many tagged series.
+"""
+import array
+import numbers
+import threading
+import time
+
+import pyformance
+
+from . import tagged_registry
+
+# counter slots of all registries are striped over these locks
+_LOCK_STRIPES = 64
+_SLOT_LOCKS = [threading.Lock() for _ in range(_LOCK_STRIPES)]
+
+
+class _Storage(object):
+    """Slots and value arrays of a CompactTaggedRegistry.
+
+    clear() swaps in a new storage and invalidates the old one, so handles
+    onto the old storage look their key up again.
+    """
+
+    # pylint: disable=E0012,R0205,too-few-public-methods
+
+    __slots__ = ('valid', 'counter_keys', 'counter_slots', 'counter_values',
+                 'gauge_keys', 'gauge_slots', 'gauge_values')
+
+    def __init__(self):
+        """Construct empty storage."""
+        self.valid = True
+        self.counter_keys = []
+        self.counter_slots = {}
+        self.counter_values = array.array('q')
+        self.gauge_keys = []
+        self.gauge_slots = {}
+        self.gauge_values = array.array('d')
+
+
+class CompactCounter(object):
+    """Light handle onto a counter slot of a CompactTaggedRegistry.
+
+    Has the interface of pyformance.meters.Counter, but only counts
+    integers.
+    """
+
+    # pylint: disable=E0012,R0205
+
+    __slots__ = ('_registry', '_key', '_storage', '_slot')
+
+    def __init__(self, registry, key, storage, slot):
+        """Construct handle for the given slot of the storage."""
+        self._registry = registry
+        self._key = key
+        self._storage = storage
+        self._slot = slot
+
+    def _rebind(self):
+        """Look the key up again after the registry was cleared.
+
+        :raise LookupError: If the key was registered with another counter
+            since, e.g. with add().
+        """
+        # pylint: disable=protected-access
+        handle = self._registry.counter(self._key)
+        if not isinstance(handle, CompactCounter):
+            raise LookupError(f'counter {self._key!r} was registered as '
+                              f'{type(handle).__name__} after clear(), look '
+                              f'it up again')
+        self._storage, self._slot = handle._storage, handle._slot
+        return self._storage
+
+    def inc(self, val=1):
+        """Increment counter by val (default is 1)."""
+        # pylint: disable=unidiomatic-typecheck
+        if type(val) is not int and not isinstance(val, numbers.Integral):
+            raise TypeError(f'compact counter {self._key!r} only counts '
+                            f'integers, got {val!r}')
+        storage = self._storage
+        if not storage.valid:
+            storage = self._rebind()
+        slot = self._slot
+        with _SLOT_LOCKS[slot % _LOCK_STRIPES]:
+            storage.counter_values[slot] += val
+
+    def dec(self, val=1):
+        """Decrement counter by val (default is 1)."""
+        self.inc(-val)
+
+    def get_count(self):
+        """Return current value of counter."""
+        storage = self._storage
+        if not storage.valid:
+            storage = self._rebind()
+        return storage.counter_values[self._slot]
+
+    def clear(self):
+        """Reset counter to 0."""
+        storage = self._storage
+        if not storage.valid:
+            storage = self._rebind()
+        slot = self._slot
+        with _SLOT_LOCKS[slot % _LOCK_STRIPES]:
+            storage.counter_values[slot] = 0
+
+
+class CompactGauge(object):
+    """Light handle onto a gauge slot of a CompactTaggedRegistry.
+
+    Has the interface of pyformance.meters.Gauge.
+    """
+
+    # pylint: disable=E0012,R0205
+
+    __slots__ = ('_registry', '_key', '_storage', '_slot')
+
+    def __init__(self, registry, key, storage, slot):
+        """Construct handle for the given slot of the storage."""
+        self._registry = registry
+        self._key = key
+        self._storage = storage
+        self._slot = slot
+
+    def _rebind(self):
+        """Look the key up again after the registry was cleared.
+
+        :raise LookupError: If the key was registered with another gauge
+            since, e.g. with add().
+        """
+        # pylint: disable=protected-access
+        handle = self._registry.gauge(self._key)
+        if not isinstance(handle, CompactGauge):
+            raise LookupError(f'gauge {self._key!r} was registered as '
+                              f'{type(handle).__name__} after clear(), look '
+                              f'it up again')
+        self._storage, self._slot = handle._storage, handle._slot
+        return self._storage
+
+    def get_value(self):
+        """Return current value of gauge."""
+        storage = self._storage
+        if not storage.valid:
+            storage = self._rebind()
+        return storage.gauge_values[self._slot]
+
+    def set_value(self, value):
+        """Change current value of gauge."""
+        storage = self._storage
+        if not storage.valid:
+            storage = self._rebind()
+        storage.gauge_values[self._slot] = value
+
+
+class CompactTaggedRegistry(tagged_registry.TaggedRegistry):
+    """Tagged Metrics Registry with array-backed counters and gauges.
+
+    Counters are kept in a single array('q') and settable gauges in a single
+    array('d'); each encoded key maps to a slot number in the matching array.
+    Lookups return light CompactCounter / CompactGauge handles onto a slot,
+    and counter updates lock one of a fixed number of lock stripes.
+    Compact counters only hold integer values.
+
+    Metrics added through add(), callback gauges and the other metric types
+    are stored exactly like in TaggedRegistry.
+    """
+
+    def __init__(self, clock=time):
+        """Construct Compact Tagged Registry."""
+        super().__init__(clock)
+        self._slots_lock = threading.Lock()
+        self._storage = _Storage()
+
+    def add(self, key, metric):
+        """Add custom metric instance, unless key is already in compact use."""
+        if ((isinstance(metric, pyformance.meters.Counter)
+             and key in self._storage.counter_slots)
+                or (isinstance(metric, pyformance.meters.Gauge)
+                    and key in self._storage.gauge_slots)):
+            raise LookupError(f'Metric {key!r} already registered')
+        super().add(key, metric)
+
+    # pylint: disable=arguments-differ
+    def counter(self, key, tags=None):
+        """Get a counter based on a encoded key."""
+        key = self.encode_key(key, tags)
+        storage = self._storage
+        slot = storage.counter_slots.get(key)
+        if slot is None:
+            if key in self._counters:
+                return self._counters[key]
+            with self._slots_lock:
+                storage = self._storage
+                slot = storage.counter_slots.get(key)
+                if slot is None:
+                    slot = len(storage.counter_values)
+                    storage.counter_values.append(0)
+                    storage.counter_keys.append(key)
+                    storage.counter_slots[key] = slot
+        return CompactCounter(self, key, storage, slot)
+
+    # pylint: disable=arguments-differ
+    def gauge(self, key, gauge=None, default=float('nan'), tags=None):
+        """Get a gauge based on a encoded key.
+
+        Callback gauges and Gauge instances are stored as in TaggedRegistry.
+        """
+        key = self.encode_key(key, tags)
+        storage = self._storage
+        slot = storage.gauge_slots.get(key)
+        if slot is None:
+            if gauge is not None or key in self._gauges:
+                return pyformance.MetricsRegistry.gauge(
+                    self, key, gauge, default)
+            with self._slots_lock:
+                storage = self._storage
+                slot = storage.gauge_slots.get(key)
+                if slot is None:
+                    slot = len(storage.gauge_values)
+                    storage.gauge_values.append(default)
+                    storage.gauge_keys.append(key)
+                    storage.gauge_slots[key] = slot
+        return CompactGauge(self, key, storage, slot)
+
+    def has_counter(self, key, tags=None):
+        """Return True if given key matches any counters."""
+        key = self.encode_key(key, tags)
+        return key in self._storage.counter_slots or key in self._counters
+
+    def has_gauge(self, key, tags=None):
+        """Return True if given key matches any gauges."""
+        key = self.encode_key(key, tags)
+        return key in self._storage.gauge_slots or key in self._gauges
+
+    def clear(self):
+        """Remove all metrics, including the compact ones.
+
+        Handles obtained before keep working, on new slots of their keys.
+        """
+        super().clear()
+        with self._slots_lock:
+            self._storage.valid = False
+            self._storage = _Storage()
+
+    def _get_counter_metrics(self, key):
+        storage = self._storage
+        slot = storage.counter_slots.get(key)
+        if slot is not None:
+            return {'count': storage.counter_values[slot]}
+        return super()._get_counter_metrics(key)
+
+    def _get_gauge_metrics(self, key):
+        storage = self._storage
+        slot = storage.gauge_slots.get(key)
+        if slot is not None:
+            return {'value': storage.gauge_values[slot]}
+        return super()._get_gauge_metrics(key)
+
+    def dump_metrics(self):
+        """Format all metrics, reading the compact arrays directly."""
+        metrics = super().dump_metrics()
+        storage = self._storage
+        for key, value in zip(storage.counter_keys, storage.counter_values):
+            metrics.setdefault(key, {})['count'] = value
+        for key, value in zip(storage.gauge_keys, storage.gauge_values):
+            metrics.setdefault(key, {})['value'] = value
+        return metrics
@@ -0,0 +1,467 @@
+# -*- coding: utf-8 -*-
+"""Record a registry workload and replay it against a local capture server.
+
+A WorkloadProfile describes the shape of a registry: per metric name the
+type, the number of series, the cardinality of each tag key, the update rate
+and a sample of the recorded values. It is recorded from a live registry
+with WorkloadProfile.record() and saved as JSON.
+
+replay() rebuilds a registry from a profile, updates it at the recorded
+rates from a load thread, and reports it with a WavefrontProxyReporter or
+WavefrontDirectReporter sending to a local HTTP server which only counts
+the received lines. Report-cycle latency, ingestion throughput and memory
+are measured every report cycle, to size batch_size and reporting_interval
+before rollout:
+
+    python -m wavefront_pyformance.replay profile.json --duration 120
+"""
+
+from __future__ import unicode_literals
+
+import argparse
+import collections
+import gzip
+import http.server
+import json
+import logging
+import math
+import random
+import threading
+import time
+
+from . import compact_registry
+from . import delta
+from . import tagged_registry
+from . import wavefront_histogram
+from . import wavefront_reporter
+
+LOGGER = logging.getLogger('wavefront_pyformance.replay')
+
+COUNTER = 'counter'
+DELTA_COUNTER = 'delta_counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+METER = 'meter'
+TIMER = 'timer'
+WAVEFRONT_HISTOGRAM = 'wavefront_histogram'
+
+CycleStats = collections.namedtuple(
+    'CycleStats', 'cycle elapsed report_seconds points points_per_second '
+                  'rss_mib failures')
+
+
+def _weighted(values):
+    """Return the given values with weight 1."""
+    return [(value, 1) for value in values]
+
+
+def _counts(registry, with_values=True):
+    """Return metric type, observed update count and values per key.
+
+    Values are (value, weight) pairs, Wavefront histograms return their
+    centroids of the current minute.
+    """
+    # pylint: disable=protected-access
+    counts = {}
+    for key, counter in list(registry._counters.items()):
+        metric_type = (DELTA_COUNTER if delta.is_delta_counter(key, registry)
+                       else COUNTER)
+        counts[key] = (metric_type, counter.get_count(), ())
+    for key, gauge in list(registry._gauges.items()):
+        counts[key] = (GAUGE, 0, ((gauge.get_value(), 1),))
+    if isinstance(registry, compact_registry.CompactTaggedRegistry):
+        # counters and settable gauges held in the compact arrays
+        storage = registry._storage
+        for key, value in list(zip(storage.counter_keys,
+                                   storage.counter_values)):
+            counts[key] = (COUNTER, value, ())
+        for key, value in list(zip(storage.gauge_keys,
+                                   storage.gauge_values)):
+            counts[key] = (GAUGE, 0, ((value, 1),))
+    for key, meter in list(registry._meters.items()):
+        counts[key] = (METER, meter.get_count(), ())
+    for key, timer in list(registry._timers.items()):
+        counts[key] = (TIMER, timer.get_count(), _weighted(
+            timer.hist.get_snapshot().values) if with_values else ())
+    for key, histogram in list(registry._histograms.items()):
+        if isinstance(histogram, wavefront_histogram.WavefrontHistogram):
+            centroids = [centroid for dist
+                         in histogram.get_current_minute_distribution()
+                         for centroid in dist.centroids]
+            counts[key] = (WAVEFRONT_HISTOGRAM,
+                           histogram.get_count() + sum(
+                               count for _, count in centroids),
+                           centroids)
+        else:
+            counts[key] = (HISTOGRAM, histogram.get_count(), _weighted(
+                histogram.get_snapshot().values) if with_values else ())
+    return counts
+
+
+def _sample_values(weighted_values, max_values, sampler):
+    """Return at most max_values values drawn by weight."""
+    weighted_values = [
+        (value, weight) for value, weight in weighted_values
+        if not (isinstance(value, float) and math.isnan(value))]
+    if sum(weight for _, weight in weighted_values) <= max_values:
+        return [value for value, weight in weighted_values
+                for _ in range(int(weight))]
+    return sampler.choices([value for value, _ in weighted_values],
+                           [weight for _, weight in weighted_values],
+                           k=max_values)
+
+
+class WorkloadProfile(object):
+    """Shape of a registry workload, replayable without its data."""
+
+    # pylint: disable=E0012,R0205
+
+    def __init__(self, groups=None):
+        """Construct Workload Profile.
+
+        :param groups: List of dicts with the keys name, type, series, tags
+            (cardinality per tag key), rate (updates per second over all
+            series) and values (sample of the recorded values).
+        """
+        self.groups = groups or []
+
+    # pylint: disable=too-many-locals
+    @classmethod
+    def record(cls, registry, seconds=10, max_values=1000):
+        """Record the workload of a live registry.
+
+        Update rates are derived from the growth of the metric counts over
+        the given number of seconds, and of gauges from the number of series
+        whose value changed. Delta counters are decremented when reported, so
+        record them while no report is due.
+
+        :param registry: TaggedRegistry updated by the application.
+        :param seconds: Seconds to observe the registry for.
+        :param max_values: Size of the value sample kept per metric name.
+        """
+        before = _counts(registry, with_values=False)
+        time.sleep(seconds)
+        after = _counts(registry)
+
+        groups = collections.OrderedDict()
+        for key, (metric_type, count, values) in after.items():
+            name, tags = wavefront_reporter.WavefrontReporter.decode_key(key)
+            group = groups.setdefault((name, metric_type), {
+                'name': name, 'type': metric_type, 'series': 0,
+                'tags': collections.defaultdict(set), 'updates': 0,
+                'values': []})
+            group['series'] += 1
+            for tag_key, tag_value in (tags or {}).items():
+                group['tags'][tag_key].add(tag_value)
+            previous_type, previous_count, previous_values = before.get(
+                key, (metric_type, 0, ()))
+            if metric_type == GAUGE:
+                # repr, as an unset gauge is NaN, which never equals itself
+                group['updates'] += int(repr(values) != repr(previous_values))
+            elif previous_type == metric_type:
+                group['updates'] += max(0, count - previous_count)
+            group['values'].extend(values)
+
+        sampler = random.Random(0)
+        return cls([{
+            'name': group['name'], 'type': group['type'],
+            'series': group['series'],
+            'tags': {tag_key: len(tag_values) for tag_key, tag_values
+                     in sorted(group['tags'].items())},
+            'rate': group['updates'] / seconds,
+            'values': _sample_values(group['values'], max_values, sampler)}
+                    for group in groups.values()])
+
+    def to_json(self):
+        """Format the profile as JSON."""
+        return json.dumps({'groups': self.groups}, indent=2)
+
+    @classmethod
+    def from_json(cls, text):
+        """Parse a profile formatted by to_json()."""
+        return cls(json.loads(text)['groups'])
+
+    def save(self, path):
+        """Save the profile as JSON file."""
+        with open(path, 'w', encoding='utf-8') as profile_file:
+            profile_file.write(self.to_json())
+
+    @classmethod
+    def load(cls, path):
+        """Load a profile saved with save()."""
+        with open(path, encoding='utf-8') as profile_file:
+            return cls.from_json(profile_file.read())
+
+
+class WorkloadReplay(object):
+    """Registry rebuilt from a WorkloadProfile, updated deterministically.
+
+    Series, tag values and the sequence of updates only depend on the
+    profile and the seed.
+    """
+
+    # pylint: disable=E0012,R0205,too-few-public-methods
+
+    def __init__(self, profile, registry=None, seed=0):
+        """Construct Workload Replay.
+
+        :param profile: WorkloadProfile to replay.
+        :param registry: TaggedRegistry to register the series with.
+        :param seed: Seed of the update sequence.
+        """
+        self.registry = registry or tagged_registry.TaggedRegistry()
+        self._random = random.Random(seed)
+        self._groups = [(group, self._register(group))
+                        for group in profile.groups]
+        self._carry = [0.0] * len(self._groups)
+        self.updates = 0
+
+    def _register(self, group):
+        """Register the series of a profile group, return the metrics."""
+        cardinalities = sorted(group.get('tags', {}).items())
+        series = max(1, group.get('series', 1))
+        if cardinalities:
+            combinations = 1
+            for _, cardinality in cardinalities:
+                combinations *= max(1, cardinality)
+            series = min(series, combinations)
+        metrics = []
+        for index in range(series):
+            tags = {}
+            for tag_key, cardinality in cardinalities:
+                index, tag_index = divmod(index, max(1, cardinality))
+                tags[tag_key] = f'{tag_key}-{tag_index}'
+            metrics.append(self._new_metric(group['name'], group['type'],
+                                            tags or None))
+        return metrics
+
+    def _new_metric(self, name, metric_type, tags):
+        """Register one series of the given type."""
+        if metric_type == DELTA_COUNTER:
+            return delta.delta_counter(self.registry, name, tags)
+        if metric_type == WAVEFRONT_HISTOGRAM:
+            return wavefront_histogram.wavefront_histogram(
+                self.registry, name, tags)
+        if metric_type not in (COUNTER, GAUGE, HISTOGRAM, METER, TIMER):
+            raise ValueError(f'invalid metric type {metric_type}')
+        return getattr(self.registry, metric_type)(name, tags=tags)
+
+    def step(self, seconds):
+        """Apply the updates due in the given number of seconds.
+
+        :return: Number of updates applied.
+        """
+        applied = 0
+        for index, (group, metrics) in enumerate(self._groups):
+            due = group.get('rate', 0) * seconds + self._carry[index]
+            updates = int(due)
+            self._carry[index] = due - updates
+            values = group.get('values') or [1.0]
+            metric_type = group['type']
+            for _ in range(updates):
+                metric = self._random.choice(metrics)
+                value = self._random.choice(values)
+                if metric_type in (COUNTER, DELTA_COUNTER):
+                    metric.inc()
+                elif metric_type == GAUGE:
+                    metric.set_value(value)
+                elif metric_type == METER:
+                    metric.mark()
+                elif metric_type == TIMER:
+                    metric._update(value)  # pylint: disable=protected-access
+                else:
+                    metric.add(value)
+            applied += updates
+        self.updates += applied
+        return applied
+
+
+class _CaptureHandler(http.server.BaseHTTPRequestHandler):
+    """HTTP handler counting the lines of proxy and direct ingestion."""
+
+    # pylint: disable=invalid-name
+    def do_POST(self):
+        """Count the lines of a report."""
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        self.server.add_lines(body.count(b'\n') + (
+            1 if body and not body.endswith(b'\n') else 0), len(body))
+        self.send_response(202)
+        self.end_headers()
+
+    # pylint: disable=redefined-builtin
+    def log_message(self, format, *args):
+        """Do not log requests."""
+
+
+class CaptureServer(http.server.ThreadingHTTPServer):
+    """Local stand-in for a Wavefront proxy or server, counting lines."""
+
+    daemon_threads = True
+
+    def __init__(self, host='localhost', port=0):
+        """Construct Capture Server, port 0 picks a free port."""
+        super().__init__((host, port), _CaptureHandler)
+        self._lines_lock = threading.Lock()
+        self.lines = 0
+        self.bytes = 0
+        self.requests = 0
+
+    @property
+    def port(self):
+        """Port the server listens on."""
+        return self.server_address[1]
+
+    def add_lines(self, lines, size):
+        """Count the lines and bytes of a request."""
+        with self._lines_lock:
+            self.lines += lines
+            self.bytes += size
+            self.requests += 1
+
+    def start(self):
+        """Serve in a daemon thread."""
+        threading.Thread(target=self.serve_forever,
+                         name='wavefront-pyformance capture',
+                         daemon=True).start()
+        return self
+
+
+def _rss_mib():
+    """Return the resident memory of the process in MiB."""
+    # pylint: disable=import-outside-toplevel
+    import psutil
+    return psutil.Process().memory_info().rss / float(2 ** 20)
+
+
+def _new_reporter(reporter, server, registry, reporting_interval,
+                  batch_size):
+    """Create a proxy or direct reporter sending to the capture server."""
+    if reporter == 'proxy':
+        wf_reporter = wavefront_reporter.WavefrontProxyReporter(
+            host='localhost', port=server.port, registry=registry,
+            source='wavefront-pyformance-replay',
+            reporting_interval=reporting_interval, batch_size=batch_size)
+    elif reporter == 'direct':
+        wf_reporter = wavefront_reporter.WavefrontDirectReporter(
+            server=f'http://localhost:{server.port}', token='replay',
+            registry=registry, source='wavefront-pyformance-replay',
+            reporting_interval=reporting_interval, batch_size=batch_size)
+    else:
+        raise ValueError(f'invalid reporter {reporter}')
+    return wf_reporter.report_minute_distribution()
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def replay(profile, reporter='proxy', duration=60, reporting_interval=10,
+           batch_size=10000, seed=0, tick=0.1, callback=None):
+    """Replay a workload against a reporter sending to a CaptureServer.
+
+    The workload is applied every tick seconds by a load thread, while the
+    calling thread reports every reporting_interval seconds. Points still
+    queued in the client are flushed when the reporter stops, and counted in
+    the last cycle.
+
+    :param profile: WorkloadProfile to replay.
+    :param reporter: 'proxy' or 'direct'.
+    :param duration: Seconds to replay for.
+    :param reporting_interval: Seconds between report cycles.
+    :param batch_size: Batch size of the Wavefront client.
+    :param seed: Seed of the update sequence.
+    :param tick: Seconds between load steps.
+    :param callback: Function called with the CycleStats of each cycle.
+    :return: List of CycleStats.
+    """
+    server = CaptureServer().start()
+    workload = WorkloadReplay(profile, seed=seed)
+    wf_reporter = _new_reporter(reporter, server, workload.registry,
+                                reporting_interval, batch_size)
+    stop = threading.Event()
+
+    def load():
+        """Apply the workload every tick until stopped."""
+        deadline = time.monotonic()
+        while not stop.is_set():
+            workload.step(tick)
+            deadline += tick
+            stop.wait(max(0.0, deadline - time.monotonic()))
+
+    load_thread = threading.Thread(target=load,
+                                   name='wavefront-pyformance load',
+                                   daemon=True)
+    stats = []
+    start = time.monotonic()
+    cycles = max(1, int(duration / reporting_interval))
+    received = 0
+    try:
+        load_thread.start()
+        for cycle in range(cycles):
+            stop.wait(max(0.0, start + (cycle + 1) * reporting_interval
+                          - time.monotonic()))
+            report_start = time.perf_counter()
+            if cycle == cycles - 1:
+                stop.set()
+                load_thread.join()
+                report = wf_reporter.stop
+            else:
+                report = wf_reporter.report_now
+            try:
+                report()
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception('Report cycle %s failed', cycle)
+            report_seconds = time.perf_counter() - report_start
+            points, received = server.lines - received, server.lines
+            cycle_stats = CycleStats(
+                cycle=cycle, elapsed=time.monotonic() - start,
+                report_seconds=report_seconds, points=points,
+                points_per_second=points / reporting_interval,
+                rss_mib=_rss_mib(),
+                failures=wf_reporter.wavefront_client.get_failure_count())
+            stats.append(cycle_stats)
+            if callback is not None:
+                callback(cycle_stats)
+    finally:
+        stop.set()
+        server.shutdown()
+        server.server_close()
+    return stats
+
+
+def main(argv=None):
+    """Replay a saved workload profile and print per-cycle statistics."""
+    arg = argparse.ArgumentParser(
+        description='Replay a workload profile against a local capture '
+                    'server.')
+    arg.add_argument('profile', help='Workload profile JSON file.')
+    arg.add_argument('--reporter', choices=('proxy', 'direct'),
+                     default='proxy', help='Reporter to replay with.')
+    arg.add_argument('--duration', type=float, default=60,
+                     help='Seconds to replay for.')
+    arg.add_argument('--reporting-interval', type=float, default=10,
+                     help='Seconds between report cycles.')
+    arg.add_argument('--batch-size', type=int, default=10000,
+                     help='Batch size of the Wavefront client.')
+    arg.add_argument('--seed', type=int, default=0,
+                     help='Seed of the update sequence.')
+    args = arg.parse_args(argv)
+
+    def show(cycle_stats):
+        print(f'cycle {cycle_stats.cycle}: t={cycle_stats.elapsed:.1f}s '
+              f'report={cycle_stats.report_seconds * 1000:.0f}ms '
+              f'points={cycle_stats.points:,} '
+              f'({cycle_stats.points_per_second:,.0f}/s) '
+              f'rss={cycle_stats.rss_mib:.1f}MiB '
+              f'failures={cycle_stats.failures}')
+
+    stats = replay(WorkloadProfile.load(args.profile), args.reporter,
+                   args.duration, args.reporting_interval, args.batch_size,
+                   args.seed, callback=show)
+    points = sum(cycle_stats.points for cycle_stats in stats)
+    print(f'total points={points:,} '
+          f'({points / stats[-1].elapsed:,.0f}/s) '
+          f'max report={max(s.report_seconds for s in stats) * 1000:.0f}ms')
+
+
+if __name__ == '__main__':
+    main()
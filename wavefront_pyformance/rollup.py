@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""Client-side rollup of metric points before they are sent."""
+
+from __future__ import unicode_literals
+
+import fnmatch
+
+from . import delta
+
+AGGREGATIONS = {
+    'sum': lambda old, new: old + new,
+    'min': min,
+    'max': max,
+}
+
+# values of dumped metrics which can be aggregated across series, min and
+# max only with themselves; averages, deviations, percentiles and rates can't
+ADDITIVE_VALUES = frozenset(('count', 'sum'))
+EXTREME_VALUES = frozenset(('min', 'max'))
+GAUGE_VALUE = 'value'
+
+
+class RollupRule(object):
+    """Rule dropping tag keys of matching metrics and aggregating the rest.
+
+    Points of matching metrics which only differ in the dropped tag keys are
+    aggregated into a single point: counts, sums and delta counters with the
+    given aggregation, min and max values with min and max, Wavefront
+    histograms by merging their centroids. Gauges are only aggregated if
+    enabled, and averages, deviations, percentiles and rates of histograms,
+    meters and timers are dropped, as they can't be aggregated.
+    """
+
+    # pylint: disable=E0012,R0205,too-few-public-methods
+
+    def __init__(self, metric, drop_tags, aggregation='sum', gauges=False):
+        """Construct Rollup Rule.
+
+        :param metric: Metric name or glob pattern, without reporter prefix
+            and without delta prefix.
+        :param drop_tags: Tag keys to drop.
+        :param aggregation: One of 'sum', 'min' and 'max'.
+        :param gauges: Aggregate matching gauges with the aggregation too,
+            instead of sending them unchanged.
+        """
+        if aggregation not in AGGREGATIONS:
+            raise ValueError(f'invalid rollup aggregation {aggregation!r}')
+        self.metric = metric
+        self.drop_tags = frozenset(drop_tags)
+        self.aggregation = aggregation
+        self.gauges = gauges
+
+    def matches(self, name):
+        """Check if the rule applies to the given metric name."""
+        if delta._has_delta_prefix(name):  # pylint: disable=protected-access
+            name = name[1:]
+        return fnmatch.fnmatchcase(name, self.metric)
+
+
+class Rollup(object):
+    """Point accumulator for one report cycle."""
+
+    # pylint: disable=E0012,R0205
+
+    def __init__(self, rules):
+        """Construct Rollup for the given list of RollupRule."""
+        self.rules = rules
+        self._rule_cache = {}
+        self._metrics = {}
+        self._delta_counters = {}
+        self._distributions = {}
+
+    def rule_for(self, name):
+        """Return the first rule matching name, or None."""
+        if name not in self._rule_cache:
+            self._rule_cache[name] = next(
+                (rule for rule in self.rules if rule.matches(name)), None)
+        return self._rule_cache[name]
+
+    @staticmethod
+    def _key(rule, name, tags):
+        return name, frozenset((key, value) for key, value in tags.items()
+                               if key not in rule.drop_tags)
+
+    @staticmethod
+    def _aggregate(points, aggregation, key, value):
+        if key in points:
+            value = AGGREGATIONS[aggregation](points[key], value)
+        points[key] = value
+
+    @staticmethod
+    def aggregates(rule, value_key):
+        """Check if rule aggregates the given value of a dumped metric.
+
+        Gauge values the rule doesn't aggregate are to be sent unchanged.
+        """
+        return value_key != GAUGE_VALUE or rule.gauges
+
+    def add_metric(self, rule, name, value_key, value, tags):
+        """Aggregate a value of a dumped metric, named name.value_key.
+
+        Values which can't be aggregated across series are dropped.
+        """
+        if value_key in EXTREME_VALUES:
+            aggregation = value_key
+        elif value_key in ADDITIVE_VALUES or value_key == GAUGE_VALUE:
+            aggregation = rule.aggregation
+        else:
+            return
+        self._aggregate(self._metrics, aggregation,
+                        self._key(rule, f'{name}.{value_key}', tags), value)
+
+    def add_delta_counter(self, rule, name, value, tags):
+        """Aggregate a delta counter point."""
+        self._aggregate(self._delta_counters, rule.aggregation,
+                        self._key(rule, name, tags), value)
+
+    def add_distribution(self, rule, name, distribution, tags):
+        """Merge the centroids of a distribution with the same minute bin."""
+        key = self._key(rule, name, tags) + (distribution.timestamp,)
+        self._distributions.setdefault(key, []).extend(
+            distribution.centroids)
+
+    # pylint: disable=too-many-arguments
+    def flush(self, wavefront_client, source, timestamp,
+              histogram_granularities):
+        """Send all aggregated points with the given client."""
+        for (name, tags), value in self._metrics.items():
+            wavefront_client.send_metric(
+                name=name, value=value, timestamp=timestamp, source=source,
+                tags=dict(tags))
+        for (name, tags), value in self._delta_counters.items():
+            wavefront_client.send_delta_counter(
+                name=name, value=value, source=source, tags=dict(tags))
+        if self._distributions:
+            self._flush_distributions(wavefront_client, source,
+                                      histogram_granularities)
+        self._metrics.clear()
+        self._delta_counters.clear()
+
+    def _flush_distributions(self, wavefront_client, source,
+                             histogram_granularities):
+        """Re-compress merged centroids and send the distributions."""
+        # pylint: disable=import-outside-toplevel
+        from wavefront_sdk.entities.histogram import histogram_impl
+
+        for (name, tags, dist_timestamp), centroids in (
+                self._distributions.items()):
+            minute_bin = histogram_impl.ThreadMinuteBin(
+                minute_millis=dist_timestamp)
+            minute_bin.bulk_update_dist_by_thread_id(
+                0, [mean for mean, _ in centroids],
+                [count for _, count in centroids])
+            for dist in minute_bin.to_distribution():
+                wavefront_client.send_distribution(
+                    name=name, centroids=dist.centroids,
+                    histogram_granularities=histogram_granularities,
+                    timestamp=dist.timestamp, source=source, tags=dict(tags))
+        self._distributions.clear()
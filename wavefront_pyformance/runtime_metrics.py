@@ -1,103 +1,137 @@
 """Python Runtime Metrics Collection Class."""
 
+import asyncio
 import gc
 import multiprocessing
 import os
 import threading
+import time
 
 import psutil
 
 
-class RuntimeCollector(object):
-    """Python Runtime Metrics Collection Class."""
+class Collector(object):
+    """Base class of runtime metric collectors.
+
+    A collector updates its gauges every `interval` report cycles. Gauges are
+    registered once and then updated in place, until the registry no longer
+    has them, e.g. after registry.clear().
+    """
 
     # pylint: disable=E0012,R0205
 
-    def __init__(self, registry=None):
-        """Construct Runtime Metrics Collector."""
-        self.registry = registry
-        self.pid = os.getpid()
-        self.process = psutil.Process(self.pid)
-        self.pname = self.process.name()
-        self.status = self.process.status()
-        self.custom_tags = {"process_id": str(self.pid),
-                            "process_name": self.pname,
-                            "process_status": self.status}
+    def __init__(self, interval=1):
+        """Construct Collector.
 
-    def collect_cputimes(self):
+        :param interval: Collect every `interval` report cycles, at least 1.
+        """
+        if interval < 1:
+            raise ValueError(f'invalid collector interval {interval!r}')
+        self.interval = interval
+        self._gauges = {}
+        self._runtime = None
+
+    def bind(self, runtime):
+        """Attach collector to a RuntimeCollector."""
+        self._runtime = runtime
+        self._gauges = {}
+
+    def set_value(self, name, value):
+        """Set value of the gauge with the given name."""
+        registry = self._runtime.registry
+        key, gauge = self._gauges.get(name, (None, None))
+        if gauge is None or not registry.has_gauge(key):
+            tags = self._runtime.custom_tags
+            key = registry.encode_key(name, tags)
+            gauge = registry.gauge(name, tags=tags)
+            self._gauges[name] = key, gauge
+        gauge.set_value(value)
+
+    def collect(self, process):
+        """Collect metrics of the given psutil.Process."""
+        raise NotImplementedError
+
+
+class CpuTimesCollector(Collector):
+    """Collect CPU Times."""
+
+    def collect(self, process):
         """Collect CPU Times."""
-        cputimes = self.process.cpu_times()
+        cputimes = process.cpu_times()
         if cputimes:
-            cpu_u_mode = cputimes.user
-            cpu_s_mode = cputimes.system
-            self.registry.gauge("cpu.times.usermode",
-                                tags=self.custom_tags).set_value(cpu_u_mode)
-            self.registry.gauge("cpu.times.systemmode",
-                                tags=self.custom_tags).set_value(cpu_s_mode)
+            self.set_value("cpu.times.usermode", cputimes.user)
+            self.set_value("cpu.times.systemmode", cputimes.system)
 
-    def collect_cpupercent(self):
+
+class CpuPercentCollector(Collector):
+    """Collect CPU in Percentage."""
+
+    def collect(self, process):
         """Collect CPU in Percentage."""
-        cpupercent = self.process.cpu_percent(interval=1)
-        self.registry.gauge("cpu.percent",
-                            tags=self.custom_tags).set_value(cpupercent)
+        cpu_percent_interval = self._runtime.cpu_percent_interval
+        if cpu_percent_interval is None:
+            cputimes = process.cpu_times()
+            lifetime = time.time() - process.create_time()
+            cpupercent = (100.0 * (cputimes.user + cputimes.system) / lifetime
+                          if lifetime > 0 else 0.0)
+        else:
+            started = time.monotonic()
+            cpupercent = process.cpu_percent(interval=cpu_percent_interval)
+            self._runtime.cpu_sample_seconds += time.monotonic() - started
+        self.set_value("cpu.percent", cpupercent)
 
-    def collect_memoryusage(self):
-        """Collect Memory Usage."""
-        memoryinfo = self.process.memory_info()
+
+class MemoryCollector(Collector):
+    """Collect Memory Usage and Memory in Percentage."""
+
+    def collect(self, process):
+        """Collect Memory Usage and Memory in Percentage."""
+        memoryinfo = process.memory_info()
         if memoryinfo:
-            rssmemory = memoryinfo.rss / float(2 ** 20)
-            self.registry.gauge("memory.rss.usage",
-                                tags=self.custom_tags).set_value(rssmemory)
+            self.set_value("memory.rss.usage", memoryinfo.rss / float(2 ** 20))
+        self.set_value("memory.rss.percent",
+                       process.memory_percent(memtype="rss"))
 
-    def collect_memorypercent(self):
-        """Collect Memory in Percentage."""
-        rssmemorypercent = self.process.memory_percent(memtype="rss")
-        self.registry.gauge("memory.rss.percent",
-                            tags=self.custom_tags).set_value(rssmemorypercent)
 
-    def collect_threads(self):
+class GarbageCollector(Collector):
+    """Collect Garbage Collection Metrics."""
+
+    def collect(self, process):
+        """Collect Garbage Collection Metrics."""
+        count0, count1, count2 = gc.get_count()
+        threshold0, threshold1, threshold2 = gc.get_threshold()
+        self.set_value("gc.collection.count0", count0)
+        self.set_value("gc.collection.count1", count1)
+        self.set_value("gc.collection.count2", count2)
+        self.set_value("gc.threshold.threshold0", threshold0)
+        self.set_value("gc.threshold.threshold1", threshold1)
+        self.set_value("gc.threshold.threshold2", threshold2)
+        self.set_value("gc.objects.count", len(gc.get_objects()))
+        self.set_value("gc.referrers.count", len(gc.get_referrers()))
+        self.set_value("gc.referents.count", len(gc.get_referents()))
+
+
+class ThreadCollector(Collector):
+    """Collect Threading Metrics."""
+
+    def collect(self, process):
         """Collect Threading Metrics."""
         counter, alive, daemon = 0, 0, 0
         for thread in threading.enumerate():
             counter += 1
-            if thread.isDaemon():
+            if thread.daemon:
                 daemon += 1
-            if thread.isAlive():
+            if thread.is_alive():
                 alive += 1
-        self.registry.gauge("thread.count",
-                            tags=self.custom_tags).set_value(counter)
-        self.registry.gauge("thread.daemon",
-                            tags=self.custom_tags).set_value(daemon)
-        self.registry.gauge("thread.alive",
-                            tags=self.custom_tags).set_value(alive)
+        self.set_value("thread.count", counter)
+        self.set_value("thread.daemon", daemon)
+        self.set_value("thread.alive", alive)
 
-    def collect_garbage(self):
-        """Collect Garbage Collection Metrics."""
-        count0, count1, count2 = gc.get_count()
-        threshold0, threshold1, threshold2 = gc.get_threshold()
-        object_count = len(gc.get_objects())
-        referrers_count = len(gc.get_referrers())
-        referents_count = len(gc.get_referents())
-        self.registry.gauge("gc.collection.count0",
-                            tags=self.custom_tags).set_value(count0)
-        self.registry.gauge("gc.collection.count1",
-                            tags=self.custom_tags).set_value(count1)
-        self.registry.gauge("gc.collection.count2",
-                            tags=self.custom_tags).set_value(count2)
-        self.registry.gauge("gc.threshold.threshold0",
-                            tags=self.custom_tags).set_value(threshold0)
-        self.registry.gauge("gc.threshold.threshold1",
-                            tags=self.custom_tags).set_value(threshold1)
-        self.registry.gauge("gc.threshold.threshold2",
-                            tags=self.custom_tags).set_value(threshold2)
-        self.registry.gauge("gc.objects.count",
-                            tags=self.custom_tags).set_value(object_count)
-        self.registry.gauge("gc.referrers.count",
-                            tags=self.custom_tags).set_value(referrers_count)
-        self.registry.gauge("gc.referents.count",
-                            tags=self.custom_tags).set_value(referents_count)
 
-    def collect_processes(self):
+class ProcessCollector(Collector):
+    """Collect Processes Details."""
+
+    def collect(self, process):
         """Collect Processes Details."""
         counter, alive, daemon = 0, 0, 0
         for proc in multiprocessing.active_children():
@@ -106,36 +140,161 @@ class RuntimeCollector(object):
                 alive += 1
             if proc.daemon:
                 daemon += 1
-        self.registry.gauge("processes.count",
-                            tags=self.custom_tags).set_value(counter)
-        self.registry.gauge("processes.alive",
-                            tags=self.custom_tags).set_value(alive)
-        self.registry.gauge("processes.daemon",
-                            tags=self.custom_tags).set_value(daemon)
+        self.set_value("processes.count", counter)
+        self.set_value("processes.alive", alive)
+        self.set_value("processes.daemon", daemon)
 
-    def collect_contextswitches(self):
+
+class ContextSwitchCollector(Collector):
+    """Collect Context Switches."""
+
+    def collect(self, process):
         """Collect Context Switches."""
         try:
-            ctx_switches = self.process.num_ctx_switches()
+            ctx_switches = process.num_ctx_switches()
         except NotImplementedError:
             # some platforms do not expose ctx switches information, this is ok
             ctx_switches = None
 
         if ctx_switches:
-            voluntary = ctx_switches.voluntary
-            involuntary = ctx_switches.involuntary
-            self.registry.gauge("ctxswitch.voluntary",
-                                tags=self.custom_tags).set_value(voluntary)
-            self.registry.gauge("ctxswitch.involuntary",
-                                tags=self.custom_tags).set_value(involuntary)
+            self.set_value("ctxswitch.voluntary", ctx_switches.voluntary)
+            self.set_value("ctxswitch.involuntary", ctx_switches.involuntary)
+
+
+class FileDescriptorCollector(Collector):
+    """Collect Open File Descriptors (Handles on Windows)."""
+
+    def collect(self, process):
+        """Collect Open File Descriptors (Handles on Windows)."""
+        if hasattr(process, 'num_fds'):
+            self.set_value("fd.count", process.num_fds())
+        elif hasattr(process, 'num_handles'):
+            self.set_value("fd.count", process.num_handles())
+
+
+class IOCountersCollector(Collector):
+    """Collect Process I/O Counters."""
+
+    def collect(self, process):
+        """Collect Process I/O Counters."""
+        # not available on every platform, nor always permitted
+        try:
+            io_counters = process.io_counters()
+        except (AttributeError, psutil.AccessDenied, NotImplementedError):
+            io_counters = None
+
+        if io_counters:
+            self.set_value("io.read.count", io_counters.read_count)
+            self.set_value("io.write.count", io_counters.write_count)
+            self.set_value("io.read.bytes", io_counters.read_bytes)
+            self.set_value("io.write.bytes", io_counters.write_bytes)
+
+
+class AsyncioCollector(Collector):
+    """Collect asyncio Task Count of an Event Loop."""
+
+    def __init__(self, loop, interval=1):
+        """Construct asyncio Collector.
+
+        :param loop: Event loop to count the tasks of. The reporter runs in
+            its own thread, without event loop.
+        """
+        super().__init__(interval)
+        self.loop = loop
+
+    def collect(self, process):
+        """Collect asyncio Task Count of an Event Loop."""
+        if self.loop.is_closed():
+            return
+        # all_tasks() only returns the tasks which are not done yet
+        self.set_value("asyncio.tasks.count",
+                       len(asyncio.all_tasks(self.loop)))
+
+
+def default_collectors():
+    """Return new instances of the collectors enabled by default."""
+    return [CpuTimesCollector(), CpuPercentCollector(), MemoryCollector(),
+            GarbageCollector(), ThreadCollector(), ProcessCollector(),
+            ContextSwitchCollector(), FileDescriptorCollector(),
+            IOCountersCollector()]
+
+
+class RuntimeCollector(object):
+    """Python Runtime Metrics Collection Class."""
+
+    # pylint: disable=E0012,R0205,too-many-instance-attributes
+
+    def __init__(self, registry=None, cpu_percent_interval=1,
+                 collectors=None):
+        """Construct Runtime Metrics Collector.
+
+        :param cpu_percent_interval: Seconds to sample CPU percent for, None
+            for the average CPU percent over the process lifetime.
+        :param collectors: List of Collector, default_collectors() by default.
+        """
+        self.registry = registry
+        self.cpu_percent_interval = cpu_percent_interval
+        # seconds the latest collect() blocked sampling CPU percent
+        self.cpu_sample_seconds = 0.0
+        self.pid = os.getpid()
+        self.process = psutil.Process(self.pid)
+        self.pname = self.process.name()
+        self.status = self.process.status()
+        self.custom_tags = {"process_id": str(self.pid),
+                            "process_name": self.pname,
+                            "process_status": self.status}
+        self.collectors = (default_collectors() if collectors is None
+                           else collectors)
+        for collector in self.collectors:
+            collector.bind(self)
+        self._cycle = 0
+        self._single_collectors = {}
+
+    def _collect_with(self, collector_class):
+        """Run a collector of the given class once."""
+        collector = self._single_collectors.get(collector_class)
+        if collector is None:
+            collector = collector_class()
+            collector.bind(self)
+            self._single_collectors[collector_class] = collector
+        collector.collect(self.process)
+
+    def collect_cputimes(self):
+        """Collect CPU Times, see CpuTimesCollector."""
+        self._collect_with(CpuTimesCollector)
+
+    def collect_cpupercent(self):
+        """Collect CPU in Percentage, see CpuPercentCollector."""
+        self._collect_with(CpuPercentCollector)
+
+    def collect_memoryusage(self):
+        """Collect Memory Usage, see MemoryCollector."""
+        self._collect_with(MemoryCollector)
+
+    def collect_memorypercent(self):
+        """Collect Memory in Percentage, see MemoryCollector."""
+        self._collect_with(MemoryCollector)
+
+    def collect_threads(self):
+        """Collect Threading Metrics, see ThreadCollector."""
+        self._collect_with(ThreadCollector)
+
+    def collect_garbage(self):
+        """Collect Garbage Collection Metrics, see GarbageCollector."""
+        self._collect_with(GarbageCollector)
+
+    def collect_processes(self):
+        """Collect Processes Details, see ProcessCollector."""
+        self._collect_with(ProcessCollector)
+
+    def collect_contextswitches(self):
+        """Collect Context Switches, see ContextSwitchCollector."""
+        self._collect_with(ContextSwitchCollector)
 
     def collect(self):
-        """All Collection Wrapper Function."""
-        self.collect_cputimes()
-        self.collect_cpupercent()
-        self.collect_memoryusage()
-        self.collect_memorypercent()
-        self.collect_garbage()
-        self.collect_threads()
-        self.collect_processes()
-        self.collect_contextswitches()
+        """Run the collectors which are due in this report cycle."""
+        self.cpu_sample_seconds = 0.0
+        for collector in self.collectors:
+            if self._cycle % collector.interval == 0:
+                collector.collect(self.process)
+        self._cycle += 1
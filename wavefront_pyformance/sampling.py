@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""Adaptive sampling of metric updates under overload."""
+
+from __future__ import unicode_literals
+
+import random
+import time
+
+import pyformance
+from pyformance.meters.timer import TimerContext, call_too_long
+
+from . import tagged_registry
+
+
+class AdaptiveSampler(object):
+    """Probabilistic sampler lowering its rate when the process is overloaded.
+
+    The reporting loop calls update() once per report cycle. The sampling rate
+    is halved (down to min_rate) while reporting takes more than
+    max_report_lag of the reporting interval or the process CPU usage
+    exceeds cpu_budget, and doubled back towards 1 otherwise.
+    """
+
+    # pylint: disable=E0012,R0205
+
+    def __init__(self, cpu_budget=None, max_report_lag=0.5, min_rate=0.01):
+        """Construct Adaptive Sampler.
+
+        :param cpu_budget: Process CPU percent above which to sample, None to
+            only react to the reporter falling behind.
+        :param max_report_lag: Fraction of the reporting interval a report
+            cycle may take before sampling.
+        :param min_rate: Lowest sampling rate.
+        """
+        self.cpu_budget = cpu_budget
+        self.max_report_lag = max_report_lag
+        self.min_rate = min_rate
+        self.rate = 1.0
+        self._last_cpu_time = time.process_time()
+        self._last_wall_time = time.monotonic()
+
+    def sample(self):
+        """Decide whether to record an event.
+
+        :return: 0 to drop the event, else the weight to record it with.
+        """
+        rate = self.rate
+        if rate >= 1.0:
+            return 1
+        return 1.0 / rate if random.random() < rate else 0
+
+    def cpu_percent(self):
+        """Return process CPU percent since the previous call."""
+        cpu_time, wall_time = time.process_time(), time.monotonic()
+        elapsed = wall_time - self._last_wall_time
+        percent = (100.0 * (cpu_time - self._last_cpu_time) / elapsed
+                   if elapsed > 0 else 0.0)
+        self._last_cpu_time, self._last_wall_time = cpu_time, wall_time
+        return percent
+
+    def update(self, report_lag):
+        """Adjust the sampling rate.
+
+        :param report_lag: Time spent in the report cycle, as a fraction of
+            the reporting interval.
+        """
+        overloaded = report_lag > self.max_report_lag
+        cpu_percent = self.cpu_percent()
+        if self.cpu_budget is not None and cpu_percent > self.cpu_budget:
+            overloaded = True
+        if overloaded:
+            self.rate = max(self.min_rate, self.rate / 2)
+        else:
+            self.rate = min(1.0, self.rate * 2)
+
+
+def add_weighted(histogram, value, weight):
+    """Add value to a pyformance Histogram as if added weight times."""
+    if weight == 1:
+        histogram.add(value)
+        return
+    with histogram.lock:
+        histogram.sample.update(value)
+        histogram.counter = histogram.counter + weight
+        histogram.max = max(histogram.max, value)
+        histogram.min = min(histogram.min, value)
+        histogram.sum = histogram.sum + value * weight
+        # weighted Welford update of Histogram._update_var
+        old_m, old_s = histogram.var
+        if old_m == -1:
+            histogram.var = [value, 0.0]
+        else:
+            new_m = old_m + weight * (value - old_m) / histogram.counter
+            new_s = old_s + weight * (value - old_m) * (value - new_m)
+            histogram.var = [new_m, new_s]
+
+
+class _WeightedTimerContext(TimerContext):
+    """Timer context recording its duration with a weight, none if 0."""
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, timer, clock, weight, *args, **kwargs):
+        """Construct Weighted Timer Context."""
+        super().__init__(timer, clock, *args, **kwargs)
+        self.weight = weight
+
+    def stop(self):
+        """Record elapsed time with the weight of the context."""
+        elapsed = self.clock.time() - self.start_time
+        if self.weight:
+            self.timer._update(  # pylint: disable=protected-access
+                elapsed, self.weight)
+        if (self.timer.threshold and self.timer.threshold < elapsed
+                and call_too_long is not None):
+            call_too_long.send(
+                self.timer, elapsed=elapsed, *self.args, **self.kwargs)
+        return elapsed
+
+
+class SampledTimer(pyformance.meters.Timer):
+    """Timer only timing the events selected by an AdaptiveSampler.
+
+    Sampled events are recorded with weight 1 / rate, so count, sum and rates
+    stay unbiased.
+    """
+
+    def __init__(self, sampler, **kwargs):
+        """Construct Sampled Timer."""
+        super().__init__(**kwargs)
+        self.sampler = sampler
+
+    # pylint: disable=arguments-differ
+    def _update(self, seconds, weight=1):
+        if seconds >= 0:
+            add_weighted(self.hist, seconds, weight)
+            self.meter.mark(weight)
+            if self.sink:
+                self.sink.add(seconds)
+
+    def time(self, *args, **kwargs):
+        """Return a timer context, which records nothing if not sampled.
+
+        Durations above the threshold of the timer are signalled either way.
+        """
+        return _WeightedTimerContext(self, self.meter.clock,
+                                     self.sampler.sample(), *args, **kwargs)
+
+
+def sampled_timer(registry, name, sampler, tags=None):
+    """Register a SampledTimer with the given registry.
+
+    :param registry: the metrics registry to register with
+    :param name: the timer name
+    :param sampler: the AdaptiveSampler selecting the timed events
+    :return: the registered SampledTimer instance
+    """
+    if not name:
+        raise ValueError('invalid timer name')
+
+    is_tagged_registry = isinstance(registry, tagged_registry.TaggedRegistry)
+
+    try:
+        timer = SampledTimer(sampler)
+        if is_tagged_registry:
+            name = tagged_registry.TaggedRegistry.encode_key(name, tags)
+        registry.add(name, timer)
+        return timer
+    except LookupError:
+        return registry._timers[name]  # pylint: disable=protected-access
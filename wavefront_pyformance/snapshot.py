@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""Snapshot of the points of one report cycle, for local consumers."""
+
+from __future__ import unicode_literals
+
+import collections
+import json
+import numbers
+import re
+
+from . import delta
+
+METRIC = 'metric'
+DELTA_COUNTER = 'delta_counter'
+DISTRIBUTION = 'distribution'
+
+Point = collections.namedtuple(
+    'Point', 'kind name value timestamp tags histogram_granularities')
+
+_INVALID_PROMETHEUS_CHARS = re.compile('[^a-zA-Z0-9_:]')
+_INVALID_PROMETHEUS_LABEL_CHARS = re.compile('[^a-zA-Z0-9_]')
+
+
+def _prometheus_name(name):
+    """Convert a Wavefront metric name into a valid Prometheus name."""
+    if delta._has_delta_prefix(name):  # pylint: disable=protected-access
+        name = name[1:]
+    name = _INVALID_PROMETHEUS_CHARS.sub('_', name)
+    return name if not name[:1].isdigit() else '_' + name
+
+
+def _prometheus_label_name(key):
+    """Convert a tag key into a valid Prometheus label name."""
+    key = _INVALID_PROMETHEUS_LABEL_CHARS.sub('_', key)
+    return key if not key[:1].isdigit() else '_' + key
+
+
+def _prometheus_labels(source, tags):
+    """Format source and tags as Prometheus labels."""
+    labels = dict(tags or {})
+    labels.setdefault('source', source)
+    escaped = (
+        (_prometheus_label_name(key),
+         str(value).replace('\\', r'\\').replace('"', r'\"')
+         .replace('\n', r'\n'))
+        for key, value in sorted(labels.items()))
+    return ','.join(f'{key}="{value}"' for key, value in escaped)
+
+
+class MetricsSnapshot(object):
+    """Points of one report cycle.
+
+    Implements the send methods of a Wavefront client, so a reporter can
+    record its points into a snapshot once, and replay them to the Wavefront
+    client and other consumers afterwards.
+    """
+
+    # pylint: disable=E0012,R0205
+
+    def __init__(self, source, timestamp=None):
+        """Construct Metrics Snapshot.
+
+        :param source: Source of the points.
+        :param timestamp: Time the snapshot was taken, in seconds.
+        """
+        self.source = source
+        self.timestamp = timestamp
+        self.points = []
+        self.exemplars = []
+
+    # pylint: disable=too-many-arguments,unused-argument
+    def send_metric(self, name, value, timestamp, source, tags):
+        """Record a metric point."""
+        self.points.append(Point(METRIC, name, value, timestamp, tags, None))
+
+    # pylint: disable=unused-argument
+    def send_delta_counter(self, name, value, source, tags, timestamp=None):
+        """Record a delta counter point."""
+        self.points.append(
+            Point(DELTA_COUNTER, name, value, timestamp, tags, None))
+
+    # pylint: disable=too-many-arguments,unused-argument
+    def send_distribution(self, name, centroids, histogram_granularities,
+                          timestamp, source, tags):
+        """Record a distribution."""
+        self.points.append(Point(DISTRIBUTION, name, centroids, timestamp,
+                                 tags, histogram_granularities))
+
+    def add_exemplars(self, name, tags, exemplars):
+        """Record exemplars of a Wavefront histogram."""
+        self.exemplars.append((name, tags, exemplars))
+
+    def send_to(self, wavefront_client):
+        """Send all points with the given Wavefront client."""
+        for point in self.points:
+            if point.kind == METRIC:
+                wavefront_client.send_metric(
+                    name=point.name, value=point.value,
+                    timestamp=point.timestamp, source=self.source,
+                    tags=point.tags)
+            elif point.kind == DELTA_COUNTER:
+                wavefront_client.send_delta_counter(
+                    name=point.name, value=point.value, source=self.source,
+                    tags=point.tags)
+            else:
+                wavefront_client.send_distribution(
+                    name=point.name, centroids=point.value,
+                    histogram_granularities=point.histogram_granularities,
+                    timestamp=point.timestamp, source=self.source,
+                    tags=point.tags)
+
+    def to_json(self):
+        """Format the snapshot as JSON."""
+        return json.dumps({
+            'source': self.source,
+            'timestamp': self.timestamp,
+            'points': [{'kind': point.kind, 'name': point.name,
+                        'value': point.value, 'timestamp': point.timestamp,
+                        'tags': point.tags or {}} for point in self.points],
+            'exemplars': [{'name': name, 'tags': tags or {},
+                           'exemplars': [exemplar._asdict()
+                                         for exemplar in exemplars]}
+                          for name, tags, exemplars in self.exemplars]},
+            ensure_ascii=False, default=str)
+
+    def to_prometheus_text(self):
+        """Format the snapshot in the Prometheus text exposition format.
+
+        Metrics and delta counters are exposed as gauges, distributions as
+        summaries without quantiles. Distributions of the same series, e.g.
+        several minute bins, are merged into one summary, and of metrics of
+        the same series the last value is exposed. Points whose name is
+        already exposed with another type, and metrics whose value is no
+        number, are left out.
+        """
+        families = {}
+        for point in self.points:
+            name = _prometheus_name(point.name)
+            labels = _prometheus_labels(self.source, point.tags)
+            metric_type = 'summary' if point.kind == DISTRIBUTION else 'gauge'
+            family_type, samples = families.setdefault(
+                name, (metric_type, {}))
+            if family_type != metric_type:
+                continue
+            if point.kind == DISTRIBUTION:
+                count, total = samples.get(labels, (0, 0))
+                samples[labels] = (
+                    count + sum(count for _, count in point.value),
+                    total + sum(mean * count for mean, count in point.value))
+            elif isinstance(point.value, numbers.Real):
+                samples[labels] = float(point.value)
+        lines = []
+        for name, (metric_type, samples) in sorted(families.items()):
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, value in samples.items():
+                if metric_type == 'summary':
+                    lines.append(f'{name}_count{{{labels}}} {value[0]}')
+                    lines.append(f'{name}_sum{{{labels}}} {value[1]}')
+                else:
+                    lines.append(f'{name}{{{labels}}} {value}')
+        return '\n'.join(lines) + '\n' if lines else ''
@@ -3,14 +3,27 @@
 
 from __future__ import unicode_literals
 
-import pyformance
+import collections
+import heapq
+import itertools
+import threading
 
-from wavefront_sdk.entities.histogram import histogram_impl
+import pyformance
 
 from . import tagged_registry
 
+Exemplar = collections.namedtuple('Exemplar', 'timestamp value context')
+
+
+def _new_histogram_impl(clock_millis=None):
+    """Create a WavefrontHistogramImpl, importing the Wavefront SDK lazily."""
+    # pylint: disable=import-outside-toplevel
+    from wavefront_sdk.entities.histogram import histogram_impl
+    return histogram_impl.WavefrontHistogramImpl(clock_millis)
 
-def wavefront_histogram(registry, name, tags=None):
+
+def wavefront_histogram(registry, name, tags=None, exemplars=0,
+                        sampler=None):
     """
     Register a DeltaCounter with the given registry and returns the instance.
 
@@ -18,6 +31,8 @@ def wavefront_histogram(registry, name, tags=None):
 
     :param registry: the metrics registry to register with
     :param name: the delta counter name
+    :param exemplars: number of slowest values to keep per minute bin
+    :param sampler: sampling.AdaptiveSampler selecting the values to add
     :return: the registered DeltaCounter instance
     """
     if not name:
@@ -26,7 +41,8 @@ def wavefront_histogram(registry, name, tags=None):
     is_tagged_registry = isinstance(registry, tagged_registry.TaggedRegistry)
 
     try:
-        wf_histogram = WavefrontHistogram()
+        wf_histogram = WavefrontHistogram(exemplars=exemplars,
+                                          sampler=sampler)
         if is_tagged_registry:
             name = tagged_registry.TaggedRegistry.encode_key(name, tags)
         registry.add(name, wf_histogram)
@@ -54,26 +70,105 @@ def get(name, registry):
                          isinstance(histogram, WavefrontHistogram)) else None
 
 
+class ExemplarReservoir(object):
+    """Keep the largest values of each minute bin with their context.
+
+    Each minute bin is a min-heap of at most `size` exemplars, so adding a
+    value is O(log size), and at most `max_bins` unflushed bins are kept.
+    """
+
+    # pylint: disable=E0012,R0205
+
+    def __init__(self, size, max_bins=11):
+        """Construct Exemplar Reservoir."""
+        self.size = size
+        self.max_bins = max_bins
+        self._bins = collections.OrderedDict()
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def add(self, minute_millis, value, context):
+        """Offer value to the bin of the given minute."""
+        with self._lock:
+            heap = self._bins.get(minute_millis)
+            if heap is None:
+                if len(self._bins) >= self.max_bins:
+                    self._bins.popitem(last=False)
+                heap = self._bins[minute_millis] = []
+            # the sequence number avoids comparing contexts of equal values
+            item = (value, next(self._sequence), context)
+            if len(heap) < self.size:
+                heapq.heappush(heap, item)
+            elif value > heap[0][0]:
+                heapq.heapreplace(heap, item)
+
+    def get(self, minute_millis):
+        """Return exemplars of the given minute, largest value first."""
+        with self._lock:
+            return self._to_exemplars(minute_millis,
+                                      self._bins.get(minute_millis, ()))
+
+    def flush(self, current_minute_millis):
+        """Remove and return exemplars of the minutes before the current."""
+        exemplars = []
+        with self._lock:
+            for minute_millis in list(self._bins):
+                if minute_millis < current_minute_millis:
+                    exemplars.extend(self._to_exemplars(
+                        minute_millis, self._bins.pop(minute_millis)))
+        return exemplars
+
+    @staticmethod
+    def _to_exemplars(minute_millis, heap):
+        return [Exemplar(minute_millis, value, context)
+                for value, _, context in sorted(heap, reverse=True)]
+
+
 class WavefrontHistogram(pyformance.meters.Histogram):
     """Wavefront Histogram Meter."""
 
-    def __init__(self, clock_millis=None):
+    def __init__(self, clock_millis=None, exemplars=0, sampler=None):
         """Construct a delegate Wavefront Histogram.
 
         @param clock_millis: A function which returns timestamp.
         @type clock_millis: function
+        @param exemplars: Number of largest values to keep per minute bin,
+        together with the context passed to add().
+        @type exemplars: int
+        @param sampler: Sampler selecting the values to add, with weight.
+        @type sampler: sampling.AdaptiveSampler
         """
+        self._clock_millis = clock_millis
+        self._sampler = sampler
+        self._exemplars = None
+        # pyformance's constructor calls clear(), creating the delegate
         super().__init__()
-        self._delegate = histogram_impl.WavefrontHistogramImpl(clock_millis)
+        if exemplars:
+            self._exemplars = ExemplarReservoir(exemplars)
 
-    def add(self, value):
-        """Update the value."""
-        self._delegate.update(value)
+    def add(self, value, context=None):
+        """Update the value.
+
+        @param context: Small dict kept with the value if it is an exemplar,
+        e.g. a trace id.
+        """
+        weight = 1 if self._sampler is None else self._sampler.sample()
+        if weight == 1:
+            self._delegate.update(value)
+        elif weight:
+            self._delegate.bulk_update([value], [weight])
+        else:
+            return self
+        if self._exemplars is not None:
+            self._exemplars.add(self._delegate.current_minute_millis(), value,
+                                context)
         return self
 
     def clear(self):
         """Instantiate brand new WevefrontHistogramImpl()."""
-        self._delegate = histogram_impl.WavefrontHistogramImpl()
+        self._delegate = _new_histogram_impl(self._clock_millis)
+        if self._exemplars is not None:
+            self._exemplars = ExemplarReservoir(self._exemplars.size)
 
     def get_count(self):
         """Get Count."""
@@ -114,3 +209,15 @@ class WavefrontHistogram(pyformance.meters.Histogram):
     def get_current_minute_distribution(self):
         """Get Distribution for the current minute bin."""
         return self._delegate.get_current_bin().to_distribution()
+
+    def get_exemplars(self):
+        """Get Exemplars w/o current minute bin."""
+        if self._exemplars is None:
+            return []
+        return self._exemplars.flush(self._delegate.current_minute_millis())
+
+    def get_current_minute_exemplars(self):
+        """Get Exemplars for the current minute bin."""
+        if self._exemplars is None:
+            return []
+        return self._exemplars.get(self._delegate.current_minute_millis())
@@ -1,35 +1,51 @@
 # -*- coding: utf-8 -*-
-"""WavefrontDirectReporter and WavefrontProxyReporter implementations."""
+"""WavefrontDirectReporter and WavefrontProxyReporter implementations.
+
+The Wavefront SDK, psutil and the runtime metrics collector are imported
+lazily, when a reporter is constructed or needs them, to keep the import of
+this module cheap for processes which only instrument.
+"""
 from __future__ import unicode_literals
 
+import atexit
+import collections
 import json
+import logging
+import threading
+import time
 
 import pyformance.reporters.reporter
 
-from wavefront_sdk.client_factory import WavefrontClientFactory
-from wavefront_sdk.common.constants import SDK_METRIC_PREFIX
-from wavefront_sdk.common.metrics.registry import WavefrontSdkMetricsRegistry
-from wavefront_sdk.common.utils import get_sem_ver
-from wavefront_sdk.entities.histogram import histogram_granularity
-
 from . import delta
-from . import runtime_metrics
+from . import rollup
+from . import snapshot
 from . import wavefront_histogram
 
-try:
-    from urllib.parse import urlparse
-except ImportError:
-    from urlparse import urlparse
+LOGGER = logging.getLogger('wavefront_pyformance.WavefrontReporter')
 
 
 class WavefrontReporter(pyformance.reporters.reporter.Reporter):
     """Base reporter for reporting data in Wavefront format."""
 
+    # pylint: disable=too-many-instance-attributes
+
     # pylint: disable=too-many-arguments
     def __init__(self, source='wavefront-pyformance', registry=None,
                  reporting_interval=60, clock=None, prefix='', tags=None,
-                 enable_runtime_metrics=False):
-        """Construct Wavefront Reporter."""
+                 enable_runtime_metrics=False, rollup_rules=None,
+                 runtime_collectors=None, export_deltas=False, sampler=None):
+        """Construct Wavefront Reporter.
+
+        :param rollup_rules: List of rollup.RollupRule aggregating points
+            client-side before they are sent.
+        :param runtime_collectors: List of runtime_metrics.Collector used
+            when runtime metrics are enabled, instead of the default ones.
+        :param export_deltas: Report pyformance histograms, meters and timers
+            as count and sum delta counters plus a distribution of the values
+            of the report interval, instead of cumulative statistics.
+        :param sampler: sampling.AdaptiveSampler updated every cycle of the
+            reporting loop, with its rate reported as internal metric.
+        """
         super().__init__(
             registry=registry, reporting_interval=reporting_interval,
             clock=clock)
@@ -39,7 +55,18 @@ class WavefrontReporter(pyformance.reporters.reporter.Reporter):
         self.tags = tags or {}
         self.histogram_granularities = set()
         self.enable_runtime_metrics = enable_runtime_metrics
+        self.runtime_collectors = runtime_collectors
+        self._runtime_collector = None
+        self.export_deltas = export_deltas
+        self._reported_totals = {}
+        self.sampler = sampler
+        self._report_seconds = 0.0
+        self._cpu_sample_seconds = 0.0
         self._sdk_metrics_registry = None
+        self._rollup = rollup.Rollup(rollup_rules) if rollup_rules else None
+        self._snapshot = None
+        self._flush_lock = threading.Lock()
+        self._flushed = False
 
     @staticmethod
     def decode_key(key):
@@ -53,7 +80,17 @@ class WavefrontReporter(pyformance.reporters.reporter.Reporter):
         """Collect metrics from registry and report them to Wavefront."""
         self._report(registry, timestamp, False)
 
-    def _report(self, registry=None, timestamp=None, flush_current_hist=False):
+    def snapshot(self):
+        """Return the snapshot.MetricsSnapshot of the latest report cycle.
+
+        The snapshot is computed once per report cycle and can be shared by
+        any number of local consumers, e.g. to_prometheus_text() or
+        to_json(). Returns None before the first report.
+        """
+        return self._snapshot
+
+    def _report(self, registry=None, timestamp=None, flush_current_hist=False,
+                sample_cpu=True):
         """
         Collect metrics from registry and report them to Wavefront.
 
@@ -62,12 +99,49 @@ class WavefrontReporter(pyformance.reporters.reporter.Reporter):
         :param registry: Registry
         :param timestamp: Timestamp
         :param flush_current_hist: Flush the current minute bin of histogram.
+        :param sample_cpu: Sample CPU percent of runtime metrics for 1 second,
+            otherwise report the average over the process lifetime.
         :return: None
         """
-        registry = registry or self.registry
+        started = time.monotonic()
+        self._cpu_sample_seconds = 0.0
+        try:
+            metrics_snapshot = self._take_snapshot(
+                registry or self.registry, timestamp, flush_current_hist,
+                sample_cpu)
+            self._snapshot = metrics_snapshot
+            if self.wavefront_client is not None:
+                metrics_snapshot.send_to(self.wavefront_client)
+        finally:
+            # the CPU sample of runtime metrics blocks on purpose
+            self._report_seconds = max(0.0, time.monotonic() - started
+                                       - self._cpu_sample_seconds)
+
+    def _update_sampler(self):
+        """Update the sampler with the duration of the latest report.
+
+        The lag passed to the sampler is the time spent reporting, without
+        the CPU sample of runtime metrics, as a fraction of the reporting
+        interval.
+        """
+        report_lag = 0.0
+        if self.reporting_interval:
+            report_lag = self._report_seconds / self.reporting_interval
+        self.sampler.update(report_lag)
+
+    # pylint: disable=too-many-locals,too-many-branches
+    def _take_snapshot(self, registry, timestamp, flush_current_hist,
+                       sample_cpu):
+        """Collect metrics from registry into a new MetricsSnapshot."""
+        metrics_snapshot = snapshot.MetricsSnapshot(self.source,
+                                                    self.clock.time())
         if self.enable_runtime_metrics:
-            col = runtime_metrics.RuntimeCollector(registry)
-            col.collect()
+            self._collect_runtime_metrics(registry, sample_cpu)
+        granularities = self.histogram_granularities
+        if self.export_deltas and not granularities:
+            # pylint: disable=import-outside-toplevel
+            from wavefront_sdk.entities.histogram import histogram_granularity
+            granularities = {histogram_granularity.MINUTE}
         metrics = registry.dump_metrics()
         for key in metrics.keys():
             metric_name, metric_tags = self.decode_key(key)
@@ -76,6 +150,8 @@ class WavefrontReporter(pyformance.reporters.reporter.Reporter):
                 tags = self.tags.copy()
                 tags.update(metric_tags)
 
+            rule = self._rollup and self._rollup.rule_for(metric_name)
+
             wf_hist = wavefront_histogram.get(key, registry)
             if wf_hist is not None:
                 distributions = wf_hist.get_distribution()
@@ -83,52 +159,275 @@ class WavefrontReporter(pyformance.reporters.reporter.Reporter):
                     distributions.extend(
                         wf_hist.get_current_minute_distribution())
                 for dist in distributions:
-                    self.wavefront_client.send_distribution(
-                        name=f'{self.prefix}{metric_name}',
-                        centroids=dist.centroids,
-                        histogram_granularities=self.histogram_granularities,
-                        timestamp=dist.timestamp,
-                        source=self.source,
-                        tags=tags)
+                    self._send_distribution(
+                        metrics_snapshot, rule,
+                        f'{self.prefix}{metric_name}', dist, granularities,
+                        tags)
+                exemplars = wf_hist.get_exemplars()
+                if flush_current_hist:
+                    exemplars.extend(wf_hist.get_current_minute_exemplars())
+                if exemplars:
+                    metrics_snapshot.add_exemplars(
+                        f'{self.prefix}{metric_name}', tags, exemplars)
+                    LOGGER.info('Exemplars of %s%s %s: %s', self.prefix,
+                                metric_name, tags, exemplars)
+                continue
+
+            if self.export_deltas and self._report_deltas(
+                    metrics_snapshot, registry, key, metric_name, rule,
+                    timestamp, granularities, tags):
                 continue
 
             is_delta = delta.is_delta_counter(key, registry)
             for value_key in metrics[key].keys():
                 if is_delta:
-                    self.wavefront_client.send_delta_counter(
-                        name=delta.get_delta_name(self.prefix, metric_name,
-                                                  value_key),
-                        value=metrics[key][value_key], source=self.source,
-                        tags=tags
-                    )
+                    self._send_delta_counter(
+                        metrics_snapshot, rule,
+                        delta.get_delta_name(self.prefix, metric_name,
+                                             value_key),
+                        metrics[key][value_key], tags)
                     # decrement delta counter
                     registry.counter(key).dec(metrics[key][value_key])
+                elif rule and self._rollup.aggregates(rule, value_key):
+                    self._rollup.add_metric(
+                        rule, f'{self.prefix}{metric_name}', value_key,
+                        metrics[key][value_key], tags)
                 else:
-                    self.wavefront_client.send_metric(
+                    metrics_snapshot.send_metric(
                         name=f'{self.prefix}{metric_name}.{value_key}',
                         value=metrics[key][value_key], timestamp=timestamp,
                         source=self.source, tags=tags)
 
+        if self._rollup:
+            self._rollup.flush(metrics_snapshot, self.source, timestamp,
+                               granularities)
+        # forget the totals of removed series
+        for key in self._reported_totals.keys() - metrics.keys():
+            del self._reported_totals[key]
+        return metrics_snapshot
+
+    # pylint: disable=too-many-arguments
+    def _report_deltas(self, sender, registry, key, metric_name, rule,
+                       timestamp, granularities, tags):
+        """Report a pyformance histogram, meter or timer as deltas.
+
+        Sends the count (and sum) increase since the previous report as delta
+        counters, and the values of the histogram reservoir as distribution.
+        The reservoir is cleared, so it only holds values of one interval;
+        the percentiles of the histogram then only cover one interval for
+        any other consumer of the registry too. A count lower than at the
+        previous report, e.g. after clear(), counts as reset.
+
+        :return: False if key is no histogram, meter or timer.
+        """
+        # pylint: disable=protected-access
+        if key in registry._timers:
+            hist = registry._timers[key].hist
+        elif key in registry._histograms:
+            hist = registry._histograms[key]
+        elif key in registry._meters:
+            hist = None
+        else:
+            return False
+
+        if hist is None:
+            totals = (registry._meters[key].get_count(),)
+            values = []
+        else:
+            with hist.lock:
+                totals = (hist.get_count(), hist.get_sum())
+                values = hist.get_snapshot().values
+                hist.sample.clear()
+        previous = self._reported_totals.get(key)
+        if previous is None or totals[0] < previous[0]:
+            previous = (0,) * len(totals)
+        self._reported_totals[key] = totals
+        count = totals[0] - previous[0]
+        if not count:
+            return True
+
+        delta_name = delta.DeltaCounter.DELTA_PREFIX + metric_name
+        for value_key, total, previous_total in zip(('count', 'sum'), totals,
+                                                    previous):
+            self._send_delta_counter(
+                sender, rule,
+                delta.get_delta_name(self.prefix, delta_name, value_key),
+                total - previous_total, tags)
+        if values:
+            # the reservoir holds a sample of the values, scale to count
+            scale = count / len(values)
+            centroids = [(value, max(1, int(round(weight * scale))))
+                         for value, weight in collections.Counter(
+                             values).items()]
+            # pylint: disable=import-outside-toplevel
+            from wavefront_sdk.entities.histogram import histogram_impl
+            self._send_distribution(
+                sender, rule, f'{self.prefix}{metric_name}',
+                histogram_impl.Distribution(timestamp, centroids),
+                granularities, tags)
+        return True
+
+    # pylint: disable=too-many-arguments
+    def _send_delta_counter(self, sender, rule, name, value, tags):
+        """Send delta counter point, or add it to the rollup of rule."""
+        if rule:
+            self._rollup.add_delta_counter(rule, name, value, tags)
+        else:
+            sender.send_delta_counter(
+                name=name, value=value, source=self.source, tags=tags)
+
+    # pylint: disable=too-many-arguments
+    def _send_distribution(self, sender, rule, name, dist, granularities,
+                           tags):
+        """Send distribution, or add it to the rollup of rule."""
+        if rule:
+            self._rollup.add_distribution(rule, name, dist, tags)
+        else:
+            sender.send_distribution(
+                name=name, centroids=dist.centroids,
+                histogram_granularities=granularities,
+                timestamp=dist.timestamp, source=self.source, tags=tags)
+
+    def _collect_runtime_metrics(self, registry, sample_cpu):
+        """Update runtime metrics, keeping one collector per registry."""
+        if (self._runtime_collector is None
+                or self._runtime_collector.registry is not registry):
+            # pylint: disable=import-outside-toplevel
+            from . import runtime_metrics
+            self._runtime_collector = runtime_metrics.RuntimeCollector(
+                registry, collectors=self.runtime_collectors)
+        self._runtime_collector.cpu_percent_interval = (
+            1 if sample_cpu else None)
+        self._runtime_collector.collect()
+        self._cpu_sample_seconds = self._runtime_collector.cpu_sample_seconds
+
+    def _loop(self):
+        """Report every reporting_interval seconds until stopped."""
+        while not self._stopped.is_set():
+            try:
+                self.report_now(self.registry)
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception('Failed to report metrics')
+            if self.sampler is not None:
+                self._update_sampler()
+            self._stopped.wait(self.reporting_interval)
+
+    def _stop_loop(self):
+        """Stop the reporting loop and wait for its current report."""
+        self._stopped.set()
+        loop_thread = self._loop_thread
+        if (loop_thread.is_alive()
+                and loop_thread is not threading.current_thread()):
+            loop_thread.join()
+
+    def _start_final_report(self):
+        """Return True for the first stop() or flush() call only."""
+        with self._flush_lock:
+            if self._flushed:
+                return False
+            self._flushed = True
+            return True
+
     def stop(self):
-        """Stop pyformance and wavefront reporter."""
-        self._report(registry=self.registry, flush_current_hist=True)
-        if self._sdk_metrics_registry:
-            self._sdk_metrics_registry.close(timeout_secs=1)
-        super().stop()
-        self.wavefront_client.close()
+        """Stop pyformance and wavefront reporter.
+
+        Reports a last time, including the current histogram minute bin,
+        unless stopped or flushed before.
+        """
+        if self._start_final_report():
+            self._flush(sample_cpu=True)
+
+    def flush(self, timeout=5):
+        """Report once, including the current histogram minute bin, and close.
+
+        Meant for short-lived processes which don't start() the reporter.
+        Runtime metrics skip the 1 second CPU sampling, and flush gives up
+        waiting after timeout seconds. Only the first call of flush() or
+        stop() has any effect.
+
+        :param timeout: Seconds to wait for the report and the client close.
+        :return: True if flushing completed within timeout.
+        """
+        if not self._start_final_report():
+            return True
+        flush_thread = threading.Thread(
+            target=self._flush, name='wavefront-pyformance flush',
+            daemon=True)
+        try:
+            flush_thread.start()
+        except RuntimeError:
+            # no new threads at interpreter shutdown, e.g. in atexit handlers
+            # of Python 3.12.0 and 3.12.1
+            self._flush()
+            return True
+        flush_thread.join(timeout)
+        if flush_thread.is_alive():
+            LOGGER.warning('Flushing did not complete within %s seconds',
+                           timeout)
+            return False
+        return True
+
+    def _flush(self, sample_cpu=False):
+        """Stop the loop, report once and close internal metrics and client."""
+        self._stop_loop()
+        try:
+            self._report(registry=self.registry, flush_current_hist=True,
+                         sample_cpu=sample_cpu)
+        finally:
+            if self._sdk_metrics_registry:
+                self._sdk_metrics_registry.close(timeout_secs=1)
+            if self.wavefront_client is not None:
+                self.wavefront_client.close()
+
+    def flush_on_exit(self, timeout=5):
+        """Flush the reporter when the interpreter exits."""
+        atexit.register(self.flush, timeout)
+        return self
+
+    def __enter__(self):
+        """Use reporter as context manager flushing on exit."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Flush the reporter."""
+        self.flush()
+
+    def _init_sdk_metrics_registry(self, sender_type):
+        """Set up the internal metrics registry of the reporter."""
+        # pylint: disable=import-outside-toplevel
+        from wavefront_sdk.common.constants import SDK_METRIC_PREFIX
+        from wavefront_sdk.common.metrics.registry import (
+            WavefrontSdkMetricsRegistry)
+        from wavefront_sdk.common.utils import get_sem_ver
+
+        self._sdk_metrics_registry = WavefrontSdkMetricsRegistry(
+            wf_metric_sender=self.wavefront_client,
+            source=self.source, tags=self.tags,
+            prefix=f'{SDK_METRIC_PREFIX}.pyformance.sender.{sender_type}')
+        self._sdk_metrics_registry.new_gauge(
+            'version', lambda: get_sem_ver('wavefront-pyformance'))
+        if self.sampler is not None:
+            self._sdk_metrics_registry.new_gauge(
+                'sampling.rate', lambda: self.sampler.rate)
 
     def report_minute_distribution(self):
         """Report distribution using minute granularity."""
+        # pylint: disable=import-outside-toplevel
+        from wavefront_sdk.entities.histogram import histogram_granularity
         self.histogram_granularities.add(histogram_granularity.MINUTE)
         return self
 
     def report_hour_distribution(self):
         """Report distribution using hour granularity."""
+        # pylint: disable=import-outside-toplevel
+        from wavefront_sdk.entities.histogram import histogram_granularity
         self.histogram_granularities.add(histogram_granularity.HOUR)
         return self
 
     def report_day_distribution(self):
         """Report distribution with day granularity."""
+        # pylint: disable=import-outside-toplevel
+        from wavefront_sdk.entities.histogram import histogram_granularity
         self.histogram_granularities.add(histogram_granularity.DAY)
         return self
 
@@ -136,29 +435,33 @@ class WavefrontReporter(pyformance.reporters.reporter.Reporter):
 class WavefrontProxyReporter(WavefrontReporter):
     """Requires a host and port to report data to a Wavefront proxy."""
 
-    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-arguments,too-many-locals
     def __init__(self, host, port=2878,
                  source='wavefront-pyformance', registry=None,
                  reporting_interval=60, clock=None, prefix='proxy.',
                  tags=None, enable_runtime_metrics=False,
-                 enable_internal_metrics=True):
+                 enable_internal_metrics=True, rollup_rules=None,
+                 runtime_collectors=None, export_deltas=False,
+                 sampler=None, batch_size=10000):
         """Run parent __init__ and do proxy reporter specific setup."""
+        # pylint: disable=import-outside-toplevel
+        from wavefront_sdk.client_factory import WavefrontClientFactory
         super().__init__(
             source=source, registry=registry,
             reporting_interval=reporting_interval, clock=clock, prefix=prefix,
-            tags=tags, enable_runtime_metrics=enable_runtime_metrics)
+            tags=tags, enable_runtime_metrics=enable_runtime_metrics,
+            rollup_rules=rollup_rules, runtime_collectors=runtime_collectors,
+            export_deltas=export_deltas, sampler=sampler)
+
+        self.batch_size = batch_size
 
         client_factory = WavefrontClientFactory()
-        client_factory.add_client(url=f"proxy://{host}:{port}")
+        client_factory.add_client(url=f"proxy://{host}:{port}",
+                                  batch_size=self.batch_size)
         self.wavefront_client = client_factory.get_client()
 
         if enable_internal_metrics:
-            self._sdk_metrics_registry = WavefrontSdkMetricsRegistry(
-                wf_metric_sender=self.wavefront_client,
-                source=source, tags=tags,
-                prefix=f'{SDK_METRIC_PREFIX}.pyformance.sender.proxy')
-            self._sdk_metrics_registry.new_gauge(
-                'version', lambda: get_sem_ver('wavefront-pyformance'))
+            self._init_sdk_metrics_registry('proxy')
 
     def report_now(self, registry=None, timestamp=None):
         """Collect metrics from registry and report them to Wavefront."""
@@ -173,19 +476,27 @@ class WavefrontDirectReporter(WavefrontReporter):
     directly to a Wavefront server.
     """
 
-    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-arguments,too-many-locals
     def __init__(self, server, token, source='wavefront-pyformance',
                  registry=None, reporting_interval=60, clock=None,
                  prefix='direct.', tags=None, enable_runtime_metrics=False,
-                 enable_internal_metrics=True):
+                 enable_internal_metrics=True, rollup_rules=None,
+                 runtime_collectors=None, export_deltas=False,
+                 sampler=None, batch_size=10000):
         """Run parent __init__ and do direct reporter specific setup."""
+        # pylint: disable=import-outside-toplevel
+        from urllib.parse import urlparse
+
+        from wavefront_sdk.client_factory import WavefrontClientFactory
         super().__init__(
             source=source, registry=registry,
             reporting_interval=reporting_interval, clock=clock, prefix=prefix,
-            tags=tags, enable_runtime_metrics=enable_runtime_metrics)
+            tags=tags, enable_runtime_metrics=enable_runtime_metrics,
+            rollup_rules=rollup_rules, runtime_collectors=runtime_collectors,
+            export_deltas=export_deltas, sampler=sampler)
         self.server = self._validate_url(server)
         self.token = token
-        self.batch_size = 10000
+        self.batch_size = batch_size
 
         client_factory = WavefrontClientFactory()
         parse_url = urlparse(server)
@@ -196,16 +507,13 @@ class WavefrontDirectReporter(WavefrontReporter):
         self.wavefront_client = client_factory.get_client()
 
         if enable_internal_metrics:
-            self._sdk_metrics_registry = WavefrontSdkMetricsRegistry(
-                wf_metric_sender=self.wavefront_client,
-                source=source, tags=tags,
-                prefix=f'{SDK_METRIC_PREFIX}.pyformance.sender.direct')
-            self._sdk_metrics_registry.new_gauge(
-                'version', lambda: get_sem_ver('wavefront-pyformance'))
+            self._init_sdk_metrics_registry('direct')
 
     @staticmethod
     def _validate_url(server):
         """Validate URL of server."""
+        # pylint: disable=import-outside-toplevel
+        from urllib.parse import urlparse
         parsed_url = urlparse(server)
         if not all((parsed_url.scheme, parsed_url.netloc)):
             raise ValueError('invalid server url')